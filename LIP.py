@@ -64,20 +64,68 @@ def get_pt_interactively(data, windowing=False, win_l=50, win_w=350):
     return pt
 
 
-def lip_im(data, rad=3):
-    y_coords, x_coords = np.indices(data.shape)
-    x_coords = x_coords.flatten()
-    y_coords = y_coords.flatten()
-    n_pts = len(x_coords)
+def lip_maps_nd(data, kernel):
+    """Calculates local intensity profile maps, i.e. for every point the mean absolute difference, the sum of squared
+    differences and the variance of absolute differences of its intensity and intensities in the kernel around it.
+    Only the kernel points lying inside the data are considered.
+    The SSD is calculated from correlations with the kernel: sum(I_q^2) - 2 * I_p * sum(I_q) + n * I_p^2.
+    The absolute difference isn't linear, therefore it is accumulated over the kernel offsets.
+    inputs:
+        data ... input image or volume
+        kernel ... binary kernel (disk or ball) with odd sizes
+    outputs:
+        ad_im, ssd_im, var_im ... maps of mean absolute difference, sum of squared differences and variance
+    """
+    data = data.astype(np.float)
+    kernel = kernel.astype(np.float)
+
+    # the number of kernel points inside the data, sums of intensities and squared intensities
+    counts = scindi.filters.correlate(np.ones(data.shape), kernel, mode='constant')
+    sums = scindi.filters.correlate(data, kernel, mode='constant')
+    sums_sq = scindi.filters.correlate(data**2, kernel, mode='constant')
+    ssd_im = sums_sq - 2 * data * sums + counts * data**2
+    ssd_im = np.maximum(ssd_im, 0)
+
+    ad_im = np.zeros(data.shape)
+    center = np.array(kernel.shape) // 2
+    for offset in np.argwhere(kernel) - center:
+        src = tuple(slice(max(-o, 0), s - max(o, 0)) for o, s in zip(offset, data.shape))
+        dst = tuple(slice(max(o, 0), s - max(-o, 0)) for o, s in zip(offset, data.shape))
+        ad_im[src] += np.abs(data[dst] - data[src])
+    ad_im /= counts
+
+    var_im = np.maximum(ssd_im / counts - ad_im**2, 0)
+
+    return ad_im, ssd_im, var_im
+
 
+def lip_maps(data, rad=3):
+    """Local intensity profile maps of an image calculated with a disk, see lip_maps_nd()."""
+    return lip_maps_nd(data, skimor.disk(rad))
+
+
+def lip_maps_3d(data, rad=3, slab_size=8):
+    """Local intensity profile maps of a volume calculated with a ball, see lip_maps_nd(). The volume is processed
+    by slabs of slab_size slices (plus rad slices on both sides) to keep the memory bounded.
+    """
+    kernel = skimor.ball(rad)
     ad_im = np.zeros(data.shape)
     ssd_im = np.zeros(data.shape)
     var_im = np.zeros(data.shape)
-    for i in range(n_pts):
-        ad, ssd, var = run(data, rad=rad, pt=(x_coords[i], y_coords[i]))
-        ad_im[y_coords[i], x_coords[i]] = ad
-        ssd_im[y_coords[i], x_coords[i]] = ssd
-        var_im[y_coords[i], x_coords[i]] = var
+    n_slices = data.shape[0]
+    for start in range(0, n_slices, slab_size):
+        stop = min(start + slab_size, n_slices)
+        ext_start = max(start - rad, 0)
+        ext_stop = min(stop + rad, n_slices)
+        maps = lip_maps_nd(data[ext_start:ext_stop, ...], kernel)
+        for im, slab_im in zip((ad_im, ssd_im, var_im), maps):
+            im[start:stop, ...] = slab_im[start - ext_start:stop - ext_start, ...]
+
+    return ad_im, ssd_im, var_im
+
+
+def lip_im(data, rad=3):
+    ad_im, ssd_im, var_im = lip_maps(data, rad=rad)
 
     kernel = skimor.disk(rad)
     ad_im_m = scindi.filters.convolve(ad_im, kernel)
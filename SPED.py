@@ -1,10 +1,13 @@
 from __future__ import division
 
 import sys
+import multiprocessing as mp
+import multiprocessing.sharedctypes as mpsct
 
 import numpy as np
 import matplotlib.pyplot as plt
-import networkx as nx
+import scipy.sparse as scisp
+import scipy.sparse.csgraph as scicsg
 
 from PyQt4.QtGui import QApplication
 
@@ -17,6 +20,178 @@ def cost_of_path(G, path):
         cost += G.edge[path[i]][path[i + 1]]['weight']
     return cost
 
+def get_tree_depths(preds):
+    """Calculates depths of nodes in a shortest path tree given by predecessors (negative for the root and
+    unreachable nodes) using pointer jumping, i.e. in O(log(depth)) vectorized steps.
+    """
+    parents = np.where(preds < 0, np.arange(len(preds)), preds)
+    depths = (preds >= 0).astype(np.int)
+    while True:
+        grand_parents = parents[parents]
+        if np.array_equal(grand_parents, parents):
+            break
+        depths = depths + depths[parents]
+        parents = grand_parents
+    return depths
+
+
+def shortest_path_tree(G, p0_lin):
+    """Runs one Dijkstra from p0_lin on the sparse graph G.
+    Returns
+    -------
+    sp_costs ... costs of shortest paths to all nodes, inf for unreachable nodes
+    sp_lengths ... numbers of nodes on the shortest paths (as len(path))
+    preds ... predecessors of nodes in the shortest path tree
+    """
+    sp_costs, preds = scicsg.dijkstra(G, indices=p0_lin, return_predecessors=True)
+    sp_lengths = get_tree_depths(preds) + 1
+    return sp_costs, sp_lengths, preds
+
+
+def get_path(preds, target):
+    path = [target]
+    while preds[path[-1]] >= 0:
+        path.append(preds[path[-1]])
+    return path[::-1]
+
+
+def sped_maps(data, p0, G=None, nghood=4, wtype=1):
+    '''
+    Calculates SPED values of all points from a single shortest path tree rooted in p0.
+
+    Parameters
+    ----------
+    data ... input image
+    p0 ... source point (row, col)
+    G ... sparse graph of data, created by gt.create_graph_sparse() if not given
+    nghood, wtype ... parameters of the graph
+
+    Returns
+    -------
+    cb_spc ... image of cityblock distance / shortest path cost
+    spc_spl ... image of shortest path cost / shortest path length
+    '''
+    if G is None:
+        G = gt.create_graph_sparse(data, nghood=nghood, wtype=wtype)
+    return sped_maps_from_graph(G, data.shape, p0)
+
+
+def sped_maps_from_graph(G, shape, p0):
+    p0_lin = np.ravel_multi_index(p0, shape)
+    sp_costs, sp_lengths, _ = shortest_path_tree(G, p0_lin)
+
+    # cityblock distance
+    coords = np.indices(shape).reshape((len(shape), -1))
+    cb_dists = np.abs(coords - np.array(p0).reshape((-1, 1))).sum(0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cb_spc = cb_dists / sp_costs
+        spc_spl = sp_costs / sp_lengths
+
+    return cb_spc.reshape(shape), spc_spl.reshape(shape)
+
+
+_shared_graph = None
+
+
+def _init_sped_worker(weights, indices, indptr, shape):
+    # the graph is built over the shared buffers, no copy is made
+    global _shared_graph
+    n_pts = np.prod(shape)
+    G = scisp.csr_matrix((np.frombuffer(weights), np.frombuffer(indices, dtype=np.int32),
+                          np.frombuffer(indptr, dtype=np.int32)), shape=(n_pts, n_pts))
+    _shared_graph = (G, shape)
+
+
+def _sped_worker(args):
+    i, p0 = args
+    G, shape = _shared_graph
+    cb_spc, spc_spl = sped_maps_from_graph(G, shape, p0)
+    return i, cb_spc, spc_spl
+
+
+def sped_batch(data, sources, n_jobs=None, reduce=None, nghood=4, wtype=1):
+    '''
+    Calculates SPED maps from many source points. The graph is built only once and placed into shared memory
+    as CSR arrays, the maps are calculated in a pool of worker processes.
+
+    Parameters
+    ----------
+    data ... input image
+    sources ... source points [(r1, c1), (r2, c2), ... , (rn, cn)]
+    n_jobs ... number of processes, defaults to the number of cpus, 1 means no pool
+    reduce ... None to return all the maps, 'min' or 'mean' to reduce them over the sources as they come
+               (NaN values, i.e. the source points, are ignored)
+    nghood, wtype ... parameters of the graph
+
+    Returns
+    -------
+    cb_spc ... cityblock distance / shortest path cost maps, [n_sources, H, W] or [H, W] if reduced
+    spc_spl ... shortest path cost / shortest path length maps, [n_sources, H, W] or [H, W] if reduced
+    '''
+    if reduce not in (None, 'min', 'mean'):
+        raise ValueError('Wrong reduction, use None, \'min\' or \'mean\'.')
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+
+    G = gt.create_graph_sparse(data, nghood=nghood, wtype=wtype)
+    weights = mpsct.RawArray('d', len(G.data))
+    indices = mpsct.RawArray('i', len(G.indices))
+    indptr = mpsct.RawArray('i', len(G.indptr))
+    np.frombuffer(weights)[:] = G.data
+    np.frombuffer(indices, dtype=np.int32)[:] = G.indices
+    np.frombuffer(indptr, dtype=np.int32)[:] = G.indptr
+    del G
+
+    initargs = (weights, indices, indptr, data.shape)
+    jobs = list(enumerate(sources))
+    if n_jobs == 1:
+        _init_sped_worker(*initargs)
+        results = (_sped_worker(job) for job in jobs)
+    else:
+        pool = mp.Pool(n_jobs, initializer=_init_sped_worker, initargs=initargs)
+        results = pool.imap_unordered(_sped_worker, jobs)
+
+    if reduce is None:
+        out_shape = (len(jobs),) + data.shape
+    else:
+        out_shape = data.shape
+    cb_spcs = np.zeros(out_shape)
+    spc_spls = np.zeros(out_shape)
+    if reduce == 'min':
+        cb_spcs.fill(np.nan)
+        spc_spls.fill(np.nan)
+    elif reduce == 'mean':
+        cb_counts = np.zeros(out_shape, dtype=np.int)
+        spc_counts = np.zeros(out_shape, dtype=np.int)
+
+    for i, cb_spc, spc_spl in results:
+        if reduce is None:
+            cb_spcs[i] = cb_spc
+            spc_spls[i] = spc_spl
+        elif reduce == 'min':
+            np.fmin(cb_spcs, cb_spc, out=cb_spcs)
+            np.fmin(spc_spls, spc_spl, out=spc_spls)
+        else:
+            cb_valid = np.logical_not(np.isnan(cb_spc))
+            spc_valid = np.logical_not(np.isnan(spc_spl))
+            cb_spcs[cb_valid] += cb_spc[cb_valid]
+            spc_spls[spc_valid] += spc_spl[spc_valid]
+            cb_counts += cb_valid
+            spc_counts += spc_valid
+
+    if n_jobs != 1:
+        pool.close()
+        pool.join()
+
+    if reduce == 'mean':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cb_spcs /= cb_counts
+            spc_spls /= spc_counts
+
+    return cb_spcs, spc_spls
+
+
 def single_source(data):
     plt.figure()
     plt.imshow(data, 'gray', interpolation='nearest')
@@ -29,11 +204,8 @@ def single_source(data):
         return
 
     pt0 = (int(round(pt0[0][0])), int(round(pt0[0][1]))) #[(int(round(x[0])), int(round(x[1]))) for x in pts]
-    pts = np.indices(data.shape).reshape((2, np.prod(data.shape)))
-    pts = [(x[0], x[1]) for x in pts.transpose()]
 
-    speds = run(data, pt0, pts)
-    speds_im = speds.reshape(data.shape)
+    speds_im, _ = sped_maps(data, pt0)
 
     # plt.figure()
     # plt.imshow(speds_im, 'gray', interpolation='nearest')
@@ -82,7 +254,7 @@ def run(data, p0, pts, show=False):
     '''
 
     # graph creation
-    G = gt.create_graph(data, wtype=1)
+    G = gt.create_graph_sparse(data, wtype=1)
 
     # deriving linear indices of the points
     p0_lin = np.ravel_multi_index(p0, data.shape)
@@ -93,16 +265,11 @@ def run(data, p0, pts, show=False):
     int0 = data[p0]
     ints = [data[x] for x in pts]
 
-    # calculating shortest paths and their costs
-    paths = list()
-    sp_costs = list()
-    sp_lengths = list()
-    for i in range(n_pts):
-        path = nx.shortest_path(G, p0_lin, pts_lin[i], 'weight')
-        paths.append(path)
-        sp_lengths.append(len(path))
-        cost = cost_of_path(G, path)
-        sp_costs.append(cost)
+    # calculating shortest paths and their costs - one shortest path tree for all the points
+    sp_costs_all, sp_lengths_all, preds = shortest_path_tree(G, p0_lin)
+    paths = [get_path(preds, x) for x in pts_lin]
+    sp_costs = list(sp_costs_all[pts_lin])
+    sp_lengths = list(sp_lengths_all[pts_lin])
 
     # cityblock distance
     cb_dists = list()
@@ -114,6 +281,7 @@ def run(data, p0, pts, show=False):
     # SPED value
     cb_spc = np.array(cb_dists) / np.array(sp_costs)
     spc_spl = np.array(sp_costs) / np.array(sp_lengths)
+    speds = cb_spc
      # = 1 / (np.array(dists) * np.array(costs))
     # speds = np.exp(np.absolute(ints - int0)) * np.array(dists) / np.array(costs)
 
@@ -10,9 +10,12 @@ import sys
 import os
 import glob
 import itertools
+import multiprocessing as mp
+import multiprocessing.sharedctypes as mpsct
 
 import pickle
 import gzip
+import hashlib
 import xlsxwriter
 
 import cv2
@@ -29,6 +32,7 @@ from skimage import img_as_float
 from collections import namedtuple
 
 import lankton_lls
+import sfm_chanvese
 
 if os.path.exists('/home/tomas/projects/imtools/'):
     sys.path.insert(0, '/home/tomas/projects/imtools/')
@@ -371,23 +375,64 @@ def split_blob(im, prop):
     return (im1, im2)
 
 
-def lankton_ls(im, mask, method='sfm', slice=None, max_iters=1000, rad=10, alpha=0.1, scale=1., show=False, show_now=True):
+def lankton_ls(im, mask, method='sfm', slice=None, max_iters=1000, rad=10, alpha=0.1, scale=1., engine='python',
+               pool=None, show=False, show_now=True):
+    """engine ... 'python' runs the sparse field localized Chan-Vese natively (sfm_chanvese.py, method 'sfm' only),
+    'matlab' calls the original Matlab implementation through lankton_lls
+    pool ... lankton_lls.SessionPool of warm engine sessions used by the 'matlab' engine
+    """
     if scale != 1:
         # im = skitra.rescale(im, scale=scale, preserve_range=True).astype(np.uint8)
         # mask = skitra.rescale(mask, scale=scale, preserve_range=True).astype(np.bool)
         im = tools.resize_ND(im, scale=scale).astype(np.uint8)
         mask = tools.resize_ND(mask, scale=scale).astype(np.bool)
 
-    seg = lankton_lls.run(im, mask, method='sfm', max_iter=1000, rad=rad, alpha=alpha,
-                          # slice=slice, show=show, show_now=show_now)
-                          slice=slice, show=True, show_now=True)
+    if engine == 'python':
+        if method != 'sfm':
+            raise ValueError('Engine \'python\' supports only method \'sfm\', use engine \'matlab\'.')
+        seg = sfm_chanvese.run(im, mask, max_iter=max_iters, rad=rad, alpha=alpha)
+    else:
+        seg = lankton_lls.run(im, mask, method=method, max_iter=max_iters, rad=rad, alpha=alpha, pool=pool,
+                              slice=slice, show=False)
 
     if show:
-        tools.visualize_seg(data, mask, seg, slice=slice, title='morph snakes', show_now=show_now)
+        tools.visualize_seg(im, mask, seg, slice=slice, title='lankton ls', show_now=show_now)
     return im, mask, seg
 
 
-def morph_snakes(data, mask, slice=None, scale=0.5, alpha=1000, sigma=1, smoothing_ls=1, threshold=0.3, balloon=1, max_iters=50, show=False, show_now=True):
+def run_mgac(mgac, max_iters, conv_thresh=0, conv_iters=None):
+    """Runs the morphological GAC until max_iters or until the number of changed voxels stays <= conv_thresh
+    for conv_iters consecutive iterations. Without conv_iters it behaves like mgac.run(iterations=max_iters).
+    outputs:
+        n_iters ... number of performed iterations
+    """
+    if conv_iters is None:
+        mgac.run(iterations=max_iters)
+        return max_iters
+
+    n_still = 0
+    for i in range(max_iters):
+        u_prev = mgac.levelset.copy()
+        mgac.step()
+        n_changed = np.count_nonzero(mgac.levelset != u_prev)
+        n_still = n_still + 1 if n_changed <= conv_thresh else 0
+        if n_still >= conv_iters:
+            return i + 1
+    return max_iters
+
+
+def get_gborders(data, scale=0.5, alpha=1000, sigma=1):
+    if scale != 1:
+        data = tools.resize3D(data, scale, sliceId=0)
+    return morphsnakes.gborders(data, alpha=alpha, sigma=sigma)
+
+
+def morph_snakes(data, mask, slice=None, scale=0.5, alpha=1000, sigma=1, smoothing_ls=1, threshold=0.3, balloon=1, max_iters=50,
+                 conv_thresh=0, conv_iters=None, gborders=None, return_iters=False, show=False, show_now=True):
+    """conv_thresh, conv_iters ... convergence criterion, see run_mgac()
+    gborders ... precomputed morphsnakes.gborders() of the rescaled data, see get_gborders()
+    return_iters ... whether to return also the iteration at which the level set stopped
+    """
     data_o = data.copy()
     mask_o = mask.copy()
     if scale != 1:
@@ -396,11 +441,14 @@ def morph_snakes(data, mask, slice=None, scale=0.5, alpha=1000, sigma=1, smoothi
         data = tools.resize3D(data, scale, sliceId=0)
         mask = tools.resize3D(mask, scale, sliceId=0)
 
-    gI = morphsnakes.gborders(data, alpha=alpha, sigma=sigma)
+    if gborders is None:
+        gI = morphsnakes.gborders(data, alpha=alpha, sigma=sigma)
+    else:
+        gI = gborders
     # Morphological GAC. Initialization of the level-set.
     mgac = morphsnakes.MorphGAC(gI, smoothing=smoothing_ls, threshold=threshold, balloon=balloon)
     mgac.levelset = mask
-    mgac.run(iterations=max_iters)
+    n_iters = run_mgac(mgac, max_iters, conv_thresh=conv_thresh, conv_iters=conv_iters)
     seg = mgac.levelset
 
     if scale != 1:
@@ -410,9 +458,87 @@ def morph_snakes(data, mask, slice=None, scale=0.5, alpha=1000, sigma=1, smoothi
 
     if show:
         tools.visualize_seg(data_o, seg, mask_o, slice=slice, title='morph snakes', show_now=show_now)
+    if return_iters:
+        return data, mask, seg, n_iters
     return data, mask, seg
 
 
+_ms_shared = None
+
+
+def _from_shared(arr):
+    # arrays are passed to the workers as tuples (buffer, dtype, shape)
+    buf, dtype, shape = arr
+    return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+
+def _init_ms_worker(data, masks, gborders):
+    global _ms_shared
+    _ms_shared = ([_from_shared(x) for x in data], [_from_shared(x) for x in masks],
+                  dict((k, _from_shared(x)) for k, x in gborders.items()))
+
+
+def _ms_job(job):
+    job_id, im_idx, gb_key, params = job
+    data, masks, gborders = _ms_shared
+    _, _, seg, n_iters = morph_snakes(data[im_idx], masks[im_idx], gborders=gborders[gb_key], return_iters=True,
+                                      **params)
+    return job_id, seg, n_iters
+
+
+def morph_snakes_batch(data, masks, params_list, conv_thresh=0, conv_iters=5, n_jobs=None):
+    """Runs morph snakes on every image with every parameter set in a pool of processes. The gborders image is
+    computed once for every image and (scale, alpha, sigma) combination, the images, masks and gborders are
+    passed to the workers through shared memory.
+    inputs:
+        data ... list of images (slices or volumes)
+        masks ... list of initial masks, one per image
+        params_list ... list of dicts with parameters of morph_snakes()
+        conv_thresh, conv_iters ... convergence criterion, see run_mgac()
+        n_jobs ... number of processes, defaults to the number of cpus, 1 means no pool
+    outputs:
+        segs ... segs[i][j] is the segmentation of i-th image with j-th parameter set
+        n_iters ... n_iters[i, j] is the iteration at which the level set stopped
+    """
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+
+    def to_shared(arr):
+        buf = mpsct.RawArray('b', arr.nbytes)
+        np.frombuffer(buf, dtype=arr.dtype).reshape(arr.shape)[...] = arr
+        return buf, arr.dtype, arr.shape
+
+    jobs = []
+    gborders = {}
+    for i, im in enumerate(data):
+        for j, params in enumerate(params_list):
+            params = dict(params, conv_thresh=conv_thresh, conv_iters=conv_iters, show=False)
+            gb_key = (i, params.get('scale', 0.5), params.get('alpha', 1000), params.get('sigma', 1))
+            if gb_key not in gborders:
+                gborders[gb_key] = to_shared(np.asarray(get_gborders(im, *gb_key[1:])))
+            jobs.append(((i, j), i, gb_key, params))
+
+    initargs = ([to_shared(np.asarray(im)) for im in data], [to_shared(np.asarray(m)) for m in masks], gborders)
+    if n_jobs == 1:
+        _init_ms_worker(*initargs)
+        results = (_ms_job(job) for job in jobs)
+    else:
+        pool = mp.Pool(n_jobs, initializer=_init_ms_worker, initargs=initargs)
+        results = pool.imap_unordered(_ms_job, jobs)
+
+    segs = [[None] * len(params_list) for i in range(len(data))]
+    n_iters = np.zeros((len(data), len(params_list)), dtype=np.int)
+    for (i, j), seg, n_it in results:
+        segs[i][j] = seg
+        n_iters[i, j] = n_it
+
+    if n_jobs != 1:
+        pool.close()
+        pool.join()
+
+    return segs, n_iters
+
+
 def calc_statistics(mask, gt):
     if mask.shape != gt.shape:
         mask = tools.resize_ND(mask, shape=gt.shape)
@@ -481,7 +607,7 @@ def write_to_xlsx(fname, items):
 
 def run(im_in, slice=None, mask=None, smoothing=True, method='sfm', max_iters=1000,
         rad=10, alpha=0.2, scale=1., init_scale=0.5,
-        sigma=1, smoothing_ls=1, threshold=0.3, balloon=1,
+        sigma=1, smoothing_ls=1, threshold=0.3, balloon=1, conv_thresh=0, conv_iters=None,
         show=False, show_now=True, save_fig=False, verbose=True):
     im = im_in.copy()
     if smoothing:
@@ -497,12 +623,14 @@ def run(im_in, slice=None, mask=None, smoothing=True, method='sfm', max_iters=10
         _debug(' Morph snakes ...', verbose, False)
         im, mask, seg = morph_snakes(im, mask, scale=scale, alpha=int(alpha), sigma=sigma, smoothing_ls=smoothing_ls,
                                      threshold=threshold, balloon=balloon, max_iters=max_iters,
+                                     conv_thresh=conv_thresh, conv_iters=conv_iters,
                                      slice=slice, show=show, show_now=show_now)
         _debug('done', verbose)
     elif method in ['sfm', 'lls']:
         _debug('SFM ...', verbose, False)
+        engine = 'python' if method == 'sfm' else 'matlab'
         im, mask, seg = lankton_ls(im, mask, method=method, max_iters=max_iters, rad=rad, alpha=alpha, scale=scale,
-                                   slice=slice, show=show, show_now=show_now)
+                                   engine=engine, slice=slice, show=show, show_now=show_now)
         _debug('done', verbose)
     return im, mask, seg
 
@@ -515,90 +643,180 @@ def _debug(msg, verbose=True, newline=True):
             print msg,
 
 
-def run_param_tuning_sfm(im_in, gt_mask, slice_ind, smoothing=True, scale=0.5, init_scale=0.5):
-    if smoothing:
-        im_in = tools.smoothing(im_in, sigmaSpace=10, sigmaColor=10, sliceId=0)
+def params_key(im, method, params):
+    """Hash of the input image, method and parameters, used as the key of the results store."""
+    h = hashlib.sha1()
+    h.update(repr((im.shape, im.dtype.str)))
+    h.update(np.ascontiguousarray(im).tostring())
+    h.update(repr((method, sorted(params.items()))))
+    return h.hexdigest()
+
+
+_sweep_shared = None
+
+
+def _init_sweep_worker(im_in, mask_init, slice_ind, method, store_dir):
+    global _sweep_shared
+    _sweep_shared = (im_in, mask_init, slice_ind, method, store_dir)
+
+
+def _sweep_job(job):
+    key, params = job
+    im_in, mask_init, slice_ind, method, store_dir = _sweep_shared
+    im, mask, seg = run(im_in, slice=slice_ind, mask=mask_init, method=method, smoothing=False, show=False,
+                        verbose=False, **params)
+    if im.shape != im_in.shape:
+        im = tools.resize_ND(im, shape=im_in.shape)
+    if mask.shape != im_in.shape:
+        mask = tools.resize_ND(mask, shape=im_in.shape)
+    if seg.shape != im_in.shape:
+        seg = tools.resize_ND(seg, shape=im_in.shape)
+
+    # writing to a temporary file and renaming, so that an interrupted run never leaves a broken result
+    datap = {'im': im, 'mask': mask, 'seg': seg, 'params': params, 'method': method}
+    fname = os.path.join(store_dir, '%s.pklz' % key)
+    f = gzip.open(fname + '.tmp', 'w')
+    pickle.dump(datap, f)
+    f.close()
+    os.rename(fname + '.tmp', fname)
+    return key
+
+
+def _save_sweep_fig(fname, slice_ind, title):
+    plt.switch_backend('Agg')
+    f = gzip.open(fname)
+    datap = pickle.load(f)
+    f.close()
+    fig = tools.visualize_seg(datap['im'], datap['seg'], datap['mask'], slice=slice_ind, title=title, for_save=True,
+                              show_now=False)
+    fig.savefig(fname.replace('.pklz', '.png'))
+    plt.close('all')
+
+
+def param_sweep(im_in, gt_mask, slice_ind, method, grid, fixed_params, store_dir, init_scale=0.5, save_figs=False,
+                n_jobs=None, verbose=True):
+    """Runs the segmentation for all parameter combinations of the grid in a pool of processes. Every result is saved
+    to store_dir under the hash of (input, method, params), combinations that are already in the store are skipped,
+    so an interrupted sweep can be restarted. Figures are rendered by a separate process from the saved results
+    (also for the skipped combinations whose figure is missing), failures of the rendering are reported at the end.
+    inputs:
+        im_in ... input image (already smoothed)
+        gt_mask ... ground truth mask
+        slice_ind ... index of the slice to visualize
+        method ... 'sfm', 'lls' or 'morphsnakes'
+        grid ... tuple of (param_name, values) pairs
+        fixed_params ... parameters shared by all combinations
+        store_dir ... directory of the results store
+        init_scale ... scale of the initialization, see tools.initialize_graycom
+        save_figs ... whether to save a png figure for every result
+        n_jobs ... number of processes, defaults to the number of cpus, 1 means no pool
+    outputs:
+        results ... list of (params, (precision, recall, f_measure)) in the order of the grid
+    """
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    names = [name for name, _ in grid]
+    params_list = []
+    for values in itertools.product(*[vals for _, vals in grid]):
+        params = dict(fixed_params, init_scale=init_scale)
+        params.update(zip(names, values))
+        params_list.append(params)
+    keys = [params_key(im_in, method, p) for p in params_list]
+    jobs = [(key, p) for key, p in zip(keys, params_list)
+            if not os.path.exists(os.path.join(store_dir, '%s.pklz' % key))]
+    _debug('Sweep: %i combinations, %i already done.' % (len(params_list), len(params_list) - len(jobs)), verbose)
+
+    mask_init = tools.initialize_graycom(im_in, slice_ind, distances=[1, ], scale=init_scale)
+    initargs = (im_in, mask_init, slice_ind, method, store_dir)
+    if n_jobs == 1:
+        _init_sweep_worker(*initargs)
+        done = (_sweep_job(job) for job in jobs)
+    else:
+        pool = mp.Pool(n_jobs, initializer=_init_sweep_worker, initargs=initargs)
+        done = pool.imap_unordered(_sweep_job, jobs)
+
+    fig_pool = mp.Pool(1) if save_figs else None
+    fig_results = []
+    if save_figs:
+        done_keys = set(keys) - set(key for key, _ in jobs)
+        for key in sorted(done_keys):
+            fname = os.path.join(store_dir, '%s.pklz' % key)
+            if not os.path.exists(fname.replace('.pklz', '.png')):
+                fig_results.append((fname, fig_pool.apply_async(_save_sweep_fig, (fname, slice_ind, method))))
+    for i, key in enumerate(done):
+        _debug('  --  done #%i/%i  --' % (i + 1, len(jobs)), verbose)
+        if save_figs:
+            fname = os.path.join(store_dir, '%s.pklz' % key)
+            fig_results.append((fname, fig_pool.apply_async(_save_sweep_fig, (fname, slice_ind, method))))
+
+    if n_jobs != 1:
+        pool.close()
+        pool.join()
+
+    # collecting results of all combinations from the store
+    results = []
+    for key, params in zip(keys, params_list):
+        f = gzip.open(os.path.join(store_dir, '%s.pklz' % key))
+        seg = pickle.load(f)['seg']
+        f.close()
+        results.append((params, calc_statistics(seg, gt_mask)))
 
-    im = im_in.copy()
-    mask_init = tools.initialize_graycom(im, slice, distances=[1, ], scale=init_scale)
+    if save_figs:
+        fig_pool.close()
+        fig_pool.join()
+        for fname, res in fig_results:
+            try:
+                res.get()
+            except Exception as e:
+                print 'Saving figure of %s failed: %s' % (fname, e)
 
-    # parameters tuning ---------------------------------------------------------------
-    alpha_v = (0.1, 0.3, 0.5, 0.8)
-    rad_v = (1, 10, 20, 30)
+    return results
 
-    method = 'sfm'
-    # create workbook for saving the resulting pracision, recall and f-measure
-    workbook = xlsxwriter.Workbook('/home/tomas/Dropbox/Data/liver_segmentation/%s/%s.xlsx' % (method, method))
+
+def write_sweep_xlsx(fname, results, param_names):
+    workbook = xlsxwriter.Workbook(fname)
     worksheet = workbook.add_worksheet()
     # Add a bold format to use to highlight cells.
     bold = workbook.add_format({'bold': True})
-    # green = workbook.add_format({'bg_color': '#C6EFCE'})
-    worksheet.write(0, 0, 'F-MEASURE',bold)
-    worksheet.write(0, 1, 'PRECISION', bold)
-    worksheet.write(0, 2, 'RECALL', bold)
-    worksheet.write(0, 4, 'alpha', bold)
-    worksheet.write(0, 5, 'rad', bold)
-    worksheet.write(0, 6, 'scale', bold)
-    worksheet.write(0, 7, 'scale_init', bold)
-
-    params_tune = []
-    for p in itertools.product(alpha_v, rad_v):
-        params_tune.append(p)
-    # for i, (alpha, sigma, threshold, balloon) in enumerate(itertools.product(alpha_v, sigma_v, threshold_v, balloon_v)):
-    for i in range(len(params_tune)):
-        alpha, rad = params_tune[i]
-        # threshold = 0.9
-        # balloon = 4
-        print '\n  --  it #%i/%i  --' % (i + 1, len(params_tune))
-        print 'Working with alpha=%.1f, rad=%i' % (alpha, rad)
-        params = {'alpha': alpha, 'rad': rad, 'max_iters': 1000, 'scale': scale, 'init_scale': init_scale,
-                  'smoothing': False, 'save_fig': False, 'show': True, 'show_now': False}
-        im, mask, seg = run(im_in, slice=slice_ind, mask=mask_init, method=method, **params)
-
-        # print 'shapes 1: im={}, mask={}, seg={}'.format(im.shape, mask.shape, seg.shape)
-        if im.shape != im_in.shape:
-            im = tools.resize_ND(im, shape=im_in.shape)
-        if mask.shape != gt_mask.shape:
-            mask = tools.resize_ND(mask, shape=gt_mask.shape)
-        if seg.shape != gt_mask.shape:
-            seg = tools.resize_ND(seg, shape=gt_mask.shape)
-        # print 'shapes 2: im={}, mask={}, seg={}'.format(im.shape, mask.shape, seg.shape)
-
-        # calculating precision, recall and f_measure
-        precision, recall, f_measure = calc_statistics(seg, gt_mask)
-        # print 'shapes 3: im={}, mask={}, seg={}'.format(im.shape, mask.shape, seg.shape)
-
-        # saving data
-        datap = {'im': im, 'mask': mask, 'seg': seg, 'params': params}
-        dirname = '/home/tomas/Dropbox/Data/liver_segmentation/%s/' % method
-        dataname = '%s_al%s_rad%i.pklz' % (method, str(alpha).replace('.', ''), rad)
-        f = gzip.open(os.path.join(dirname, dataname), 'w')
-        pickle.dump(datap, f)
-        f.close()
+    for j, name in enumerate(['F-MEASURE', 'PRECISION', 'RECALL']):
+        worksheet.write(0, j, name, bold)
+    for j, name in enumerate(param_names):
+        worksheet.write(0, j + 4, name, bold)
 
-        # saving results
-        cols = [0, 1, 2, 4, 5, 6, 7]
-        items = (f_measure, precision, recall, alpha, rad, params['scale'], params['init_scale'])
+    for i, (params, (precision, recall, f_measure)) in enumerate(results):
+        items = [f_measure, precision, recall, None] + [params[name] for name in param_names]
         for j, it in enumerate(items):
-            worksheet.write(i + 1, cols[j], it)
-
-        # creating visualization
-        fig = tools.visualize_seg(im, seg, mask, slice=slice_ind, title=method, for_save=True, show_now=False)
-        fname = '/home/tomas/Dropbox/Data/liver_segmentation/%s/%s_al%s_rad%i.png' \
-                % (method, method, str(alpha).replace('.', ''), rad)
-        fig.savefig(fname)
-        plt.close('all')
-
+            if it is not None:
+                worksheet.write(i + 1, j, it)
     workbook.close()
-    # plt.show()
 
 
-def run_param_tuning_morphsnakes(im_in, gt_mask, slice_ind, smoothing=True, scale=0.5, init_scale=0.5):
+def run_param_tuning_sfm(im_in, gt_mask, slice_ind, smoothing=True, scale=0.5, init_scale=0.5, save_figs=True,
+                         n_jobs=None):
     if smoothing:
         im_in = tools.smoothing(im_in, sigmaSpace=10, sigmaColor=10, sliceId=0)
 
-    im = im_in.copy()
-    mask_init = tools.initialize_graycom(im, slice, distances=[1, ], scale=init_scale)
+    # parameters tuning ---------------------------------------------------------------
+    alpha_v = (0.1, 0.3, 0.5, 0.8)
+    rad_v = (1, 10, 20, 30)
+
+    method = 'sfm'
+    dirname = '/home/tomas/Dropbox/Data/liver_segmentation/%s/' % method
+    grid = (('alpha', alpha_v), ('rad', rad_v))
+    results = param_sweep(im_in, gt_mask, slice_ind, method, grid, {'max_iters': 1000, 'scale': scale}, dirname,
+                          init_scale=init_scale, save_figs=save_figs, n_jobs=n_jobs)
+
+    # create workbook for saving the resulting pracision, recall and f-measure
+    write_sweep_xlsx(os.path.join(dirname, '%s.xlsx' % method), results, ['alpha', 'rad', 'scale', 'init_scale'])
+
+
+def run_param_tuning_morphsnakes(im_in, gt_mask, slice_ind, smoothing=True, scale=0.5, init_scale=0.5, save_figs=True,
+                                 n_jobs=None):
+    if smoothing:
+        im_in = tools.smoothing(im_in, sigmaSpace=10, sigmaColor=10, sliceId=0)
 
     # parameters tuning ---------------------------------------------------------------
     alpha_v = (10, 100, 500)
@@ -607,73 +825,15 @@ def run_param_tuning_morphsnakes(im_in, gt_mask, slice_ind, smoothing=True, scal
     balloon_v = (1, 2, 4)
 
     method = 'morphsnakes'
-    # create workbook for saving the resulting pracision, recall and f-measure
-    workbook = xlsxwriter.Workbook('/home/tomas/Dropbox/Data/liver_segmentation/%s/%s.xlsx' % (method, method))
-    worksheet = workbook.add_worksheet()
-    # Add a bold format to use to highlight cells.
-    bold = workbook.add_format({'bold': True})
-    # green = workbook.add_format({'bg_color': '#C6EFCE'})
-    worksheet.write(0, 0, 'F-MEASURE',bold)
-    worksheet.write(0, 1, 'PRECISION', bold)
-    worksheet.write(0, 2, 'RECALL', bold)
-    worksheet.write(0, 4, 'alpha', bold)
-    worksheet.write(0, 5, 'sigma', bold)
-    worksheet.write(0, 6, 'threshold', bold)
-    worksheet.write(0, 7, 'ballon', bold)
-    worksheet.write(0, 8, 'scale', bold)
-    worksheet.write(0, 9, 'scale_init', bold)
+    dirname = '/home/tomas/Dropbox/Data/liver_segmentation/%s/' % method
+    grid = (('alpha', alpha_v), ('sigma', sigma_v), ('threshold', threshold_v), ('balloon', balloon_v))
+    fixed_params = {'smoothing_ls': 1, 'max_iters': 1000, 'scale': scale}
+    results = param_sweep(im_in, gt_mask, slice_ind, method, grid, fixed_params, dirname,
+                          init_scale=init_scale, save_figs=save_figs, n_jobs=n_jobs)
 
-    params_tune = []
-    for p in itertools.product(alpha_v, sigma_v, threshold_v, balloon_v):
-        params_tune.append(p)
-    # for i, (alpha, sigma, threshold, balloon) in enumerate(itertools.product(alpha_v, sigma_v, threshold_v, balloon_v)):
-    for i in range(len(params_tune)):
-        alpha, sigma, threshold, balloon = params_tune[i]
-        # threshold = 0.9
-        # balloon = 4
-        print '\n  --  it #%i/%i  --' % (i + 1, len(params_tune))
-        print 'Working with alpha=%i, sigma=%i, threshold=%.1f, balloon=%i' % (alpha, sigma, threshold, balloon)
-        params = {'alpha': alpha, 'sigma': sigma, 'smoothing_ls': 1, 'threshold': threshold, 'balloon': balloon,
-                  'max_iters': 1000, 'scale': scale, 'init_scale': init_scale,
-                  'smoothing': False, 'save_fig': False, 'show': True, 'show_now': False}
-        im, mask, seg = run(im_in, slice=slice_ind, mask=mask_init, method=method, **params)
-
-        # print 'shapes 1: im={}, mask={}, seg={}'.format(im.shape, mask.shape, seg.shape)
-        if im.shape != im_in.shape:
-            im = tools.resize_ND(im, shape=im_in.shape)
-        if mask.shape != gt_mask.shape:
-            mask = tools.resize_ND(mask, shape=gt_mask.shape)
-        if seg.shape != gt_mask.shape:
-            seg = tools.resize_ND(seg, shape=gt_mask.shape)
-        # print 'shapes 2: im={}, mask={}, seg={}'.format(im.shape, mask.shape, seg.shape)
-
-        # calculating precision, recall and f_measure
-        precision, recall, f_measure = calc_statistics(seg, gt_mask)
-        # print 'shapes 3: im={}, mask={}, seg={}'.format(im.shape, mask.shape, seg.shape)
-
-        # saving data
-        datap = {'im': im, 'mask': mask, 'seg': seg, 'params': params}
-        dirname = '/home/tomas/Dropbox/Data/liver_segmentation/%s/' % method
-        dataname = '%s_al%i_si%i_th%s_ba%i.pklz' % (method, alpha, sigma, str(threshold).replace('.', ''), balloon)
-        f = gzip.open(os.path.join(dirname, dataname), 'w')
-        pickle.dump(datap, f)
-        f.close()
-
-        # saving results
-        cols = [0, 1, 2, 4, 5, 6, 7, 8, 9]
-        items = (f_measure, precision, recall, alpha, sigma, threshold, balloon, params['scale'], params['init_scale'])
-        for j, it in enumerate(items):
-            worksheet.write(i + 1, cols[j], it)
-
-        # creating visualization
-        fig = tools.visualize_seg(im, seg, mask, slice=slice_ind, title=method, for_save=True, show_now=False)
-        fname = '/home/tomas/Dropbox/Data/liver_segmentation/%s/%s_al%i_si%i_th%s_ba%i.png' \
-                % (method, method, alpha, sigma, str(threshold).replace('.', ''), balloon)
-        fig.savefig(fname)
-        plt.close('all')
-
-    workbook.close()
-    # plt.show()
+    # create workbook for saving the resulting pracision, recall and f-measure
+    write_sweep_xlsx(os.path.join(dirname, '%s.xlsx' % method), results,
+                     ['alpha', 'sigma', 'threshold', 'balloon', 'scale', 'init_scale'])
 
 #---------------------------------------------------------------------------------------------
 #---------------------------------------------------------------------------------------------
@@ -7,7 +7,9 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import numpy as np
 import skimage.exposure as skiexp
-import skimage.feature as skifea
+import skimage.transform as skitra
+from skimage import img_as_float
+import scipy.ndimage.filters as scindifil
 import scipy.stats as scista
 import skimage.color as skicol
 import skimage.data as skidat
@@ -18,6 +20,30 @@ import copy
 import math
 import os
 import datetime
+import inspect
+
+# private parts of skimage blob detectors (written against skimage 0.14), the scale space stacks are built here
+# to be reused, see ScaleSpace
+try:
+    from skimage.feature.blob import _prune_blobs
+    from skimage.feature._hessian_det_appx import _hessian_matrix_det
+except ImportError:
+    raise ImportError('Private skimage blob helpers not found, ScaleSpace needs skimage 0.14 or compatible.')
+
+
+def prune_blobs(blobs, overlap):
+    """skimage.feature.blob._prune_blobs for blobs with one sigma column, later skimage releases added
+    the keyword-only sigma_dim argument."""
+    spec = (getattr(inspect, 'getfullargspec', None) or inspect.getargspec)(_prune_blobs)
+    if 'sigma_dim' in spec.args + getattr(spec, 'kwonlyargs', []):
+        return _prune_blobs(blobs, overlap, sigma_dim=1)
+    return _prune_blobs(blobs, overlap)
+
+
+def hessian_matrix_det(integral, sigma):
+    """skimage.feature._hessian_det_appx._hessian_matrix_det of an integral image, later skimage releases accept
+    only C-contiguous float arrays."""
+    return _hessian_matrix_det(np.ascontiguousarray(integral, dtype=np.float64), float(sigma))
 
 
 # constants
@@ -80,13 +106,116 @@ def get_blob_mean_value(blobs, image, mask):
     return mean_vals
 
 
-def dog(image, mask=None, intensity='dark', min_sigma=1, max_sigma=50, sigma_ratio=2, threshold=0.1, overlap=1):
+class ScaleSpace:
+    """Scale space stacks of an image for blob detection, equivalent to the ones built by skimage.feature.blob_dog,
+    blob_log and blob_doh. Filtered images are computed once per sigma and stacks once per sigma set, local maxima
+    of a stack are found once as well, so that detections with different thresholds and overlaps only select
+    and prune the cached maxima. Pruning and the determinant of hessian use private skimage functions (written
+    against skimage 0.14), the calls go through the compatibility wrappers prune_blobs and hessian_matrix_det.
+    inputs:
+        image ... image the detector works on (i.e. already with adjusted intensity, see check_blob_intensity)
+    """
+    def __init__(self, image):
+        self.image = img_as_float(image)
+        self.cache = {}
+
+    def _cached(self, key, fcn):
+        if key not in self.cache:
+            self.cache[key] = fcn()
+        return self.cache[key]
+
+    def gaussian(self, sigma):
+        return self._cached(('gauss', sigma), lambda: scindifil.gaussian_filter(self.image, sigma))
+
+    def dog_stack(self, min_sigma=1, max_sigma=50, sigma_ratio=1.6):
+        def create():
+            # k such that min_sigma * (sigma_ratio ** k) > max_sigma
+            k = int(math.log(float(max_sigma) / min_sigma, sigma_ratio)) + 1
+            sigma_list = np.array([min_sigma * (sigma_ratio ** i) for i in range(k + 1)])
+            dogs = [(self.gaussian(sigma_list[i]) - self.gaussian(sigma_list[i + 1])) * sigma_list[i]
+                    for i in range(k)]
+            return sigma_list, np.stack(dogs, axis=-1)
+        return self._cached(('dog', min_sigma, max_sigma, sigma_ratio), create)
+
+    def log_stack(self, min_sigma=1, max_sigma=50, num_sigma=10, log_scale=False):
+        def create():
+            sigma_list = get_sigma_list(min_sigma, max_sigma, num_sigma, log_scale)
+            logs = [self._cached(('log', s), lambda: -scindifil.gaussian_laplace(self.image, s) * s ** 2)
+                    for s in sigma_list]
+            return sigma_list, np.stack(logs, axis=-1)
+        return self._cached(('log', min_sigma, max_sigma, num_sigma, log_scale), create)
+
+    def doh_stack(self, min_sigma=1, max_sigma=30, num_sigma=10, log_scale=False):
+        def create():
+            sigma_list = get_sigma_list(min_sigma, max_sigma, num_sigma, log_scale)
+            integral = self._cached('integral', lambda: skitra.integral_image(self.image))
+            dohs = [self._cached(('doh', s), lambda: hessian_matrix_det(integral, s)) for s in sigma_list]
+            return sigma_list, np.dstack(dohs)
+        return self._cached(('doh', min_sigma, max_sigma, num_sigma, log_scale), create)
+
+    def local_maxima(self, stack_key, cube):
+        """Local maxima of the stack (as skimage.feature.peak_local_max) and their values, highest index first."""
+        def create():
+            if np.all(cube == cube.flat[0]):
+                return np.zeros((0, cube.ndim), dtype=np.int), np.zeros(0)
+            cube_max = scindifil.maximum_filter(cube, footprint=np.ones((3,) * cube.ndim), mode='constant')
+            coords = np.column_stack(np.nonzero(cube == cube_max))[::-1]
+            return coords, cube[tuple(coords.T)]
+        return self._cached(('maxima',) + stack_key, create)
+
+    def find_blobs(self, stack_key, sigma_list, cube, threshold, overlap):
+        coords, vals = self.local_maxima(stack_key, cube)
+        coords = coords[vals > max(threshold, 0)]
+        if coords.size == 0:
+            return np.empty((0, 3))
+        blobs = coords.astype(np.float64)
+        blobs[:, -1] = sigma_list[coords[:, -1]]
+        return prune_blobs(blobs, overlap)
+
+    def blob_dog(self, min_sigma=1, max_sigma=50, sigma_ratio=1.6, threshold=2.0, overlap=.5):
+        sigma_list, cube = self.dog_stack(min_sigma, max_sigma, sigma_ratio)
+        return self.find_blobs(('dog', min_sigma, max_sigma, sigma_ratio), sigma_list, cube, threshold, overlap)
+
+    def blob_log(self, min_sigma=1, max_sigma=50, num_sigma=10, threshold=.2, overlap=.5, log_scale=False):
+        sigma_list, cube = self.log_stack(min_sigma, max_sigma, num_sigma, log_scale)
+        return self.find_blobs(('log', min_sigma, max_sigma, num_sigma, log_scale), sigma_list, cube, threshold,
+                               overlap)
+
+    def blob_doh(self, min_sigma=1, max_sigma=30, num_sigma=10, threshold=0.01, overlap=.5, log_scale=False):
+        sigma_list, cube = self.doh_stack(min_sigma, max_sigma, num_sigma, log_scale)
+        return self.find_blobs(('doh', min_sigma, max_sigma, num_sigma, log_scale), sigma_list, cube, threshold,
+                               overlap)
+
+
+def get_sigma_list(min_sigma, max_sigma, num_sigma, log_scale):
+    if log_scale:
+        return np.logspace(math.log(min_sigma, 10), math.log(max_sigma, 10), num_sigma)
+    return np.linspace(min_sigma, max_sigma, num_sigma)
+
+
+def doh_image(image):
+    if image.dtype.type in (np.float, np.float32, np.float64) and image.max() <= 1:
+        image = (255 * image).astype(np.uint8)
+    return image
+
+
+def create_scale_spaces(image):
+    """Scale spaces of the image shared by detections of all blob types, DoG and LoG work on the image with
+    inverted intensity (dark blobs), DoH on the uint8 image."""
+    inverted = ScaleSpace(check_blob_intensity(image, 'dark'))
+    return {BLOB_DOG: inverted, BLOB_LOG: inverted, BLOB_DOH: ScaleSpace(doh_image(image))}
+
+
+def dog(image, mask=None, intensity='dark', min_sigma=1, max_sigma=50, sigma_ratio=2, threshold=0.1, overlap=1,
+        scale_space=None):
+    """scale_space ... ScaleSpace of the image with checked intensity, created if None"""
     if mask is None:
         mask = np.ones_like(image)
-    im = check_blob_intensity(image, intensity, show=False)
+    if scale_space is None:
+        scale_space = ScaleSpace(check_blob_intensity(image, intensity, show=False))
     try:
-        blobs = skifea.blob_dog(im, min_sigma=min_sigma, max_sigma=max_sigma, sigma_ratio=sigma_ratio,
-                                threshold=threshold, overlap=overlap)
+        blobs = scale_space.blob_dog(min_sigma=min_sigma, max_sigma=max_sigma, sigma_ratio=sigma_ratio,
+                                     threshold=threshold, overlap=overlap)
     except:
         return []
     if len(blobs) > 0:
@@ -96,13 +225,16 @@ def dog(image, mask=None, intensity='dark', min_sigma=1, max_sigma=50, sigma_rat
     return blobs
 
 
-def log(image, mask=None, intensity='dark', min_sigma=1, max_sigma=50, num_sigma=10, threshold=0.05, overlap=1, log_scale=False):
+def log(image, mask=None, intensity='dark', min_sigma=1, max_sigma=50, num_sigma=10, threshold=0.05, overlap=1, log_scale=False,
+        scale_space=None):
+    """scale_space ... ScaleSpace of the image with checked intensity, created if None"""
     if mask is None:
         mask = np.ones_like(image)
-    im = check_blob_intensity(image, intensity)
+    if scale_space is None:
+        scale_space = ScaleSpace(check_blob_intensity(image, intensity))
     try:
-        blobs = skifea.blob_log(im, min_sigma=min_sigma, max_sigma=max_sigma, num_sigma=num_sigma,
-                                threshold=threshold, overlap=overlap, log_scale=log_scale)
+        blobs = scale_space.blob_log(min_sigma=min_sigma, max_sigma=max_sigma, num_sigma=num_sigma,
+                                     threshold=threshold, overlap=overlap, log_scale=log_scale)
     except:
         return []
     if len(blobs) > 0:
@@ -112,7 +244,9 @@ def log(image, mask=None, intensity='dark', min_sigma=1, max_sigma=50, num_sigma
     return blobs
 
 
-def doh(image, mask=None, intensity='dark', min_sigma=1, max_sigma=30, num_sigma=10, threshold=0.001, overlap=1, offset=10, log_scale=False):
+def doh(image, mask=None, intensity='dark', min_sigma=1, max_sigma=30, num_sigma=10, threshold=0.001, overlap=1, offset=10, log_scale=False,
+        scale_space=None):
+    """scale_space ... ScaleSpace of the image, created if None"""
     if mask is None:
         mask = np.ones_like(image)
     # im = check_blob_intensity(image, intensity='light')
@@ -124,9 +258,11 @@ def doh(image, mask=None, intensity='dark', min_sigma=1, max_sigma=30, num_sigma
     # plt.subplot(122), plt.imshow(im2, 'gray')
     # plt.show()
 
+    if scale_space is None:
+        scale_space = ScaleSpace(image)
     try:
-        blobs = skifea.blob_doh(image, min_sigma=min_sigma, max_sigma=max_sigma, num_sigma=num_sigma,
-                                threshold=threshold, overlap=overlap, log_scale=log_scale)
+        blobs = scale_space.blob_doh(min_sigma=min_sigma, max_sigma=max_sigma, num_sigma=num_sigma,
+                                     threshold=threshold, overlap=overlap, log_scale=log_scale)
     except:
         return []
     blobs = np.round(blobs).astype(np.int)
@@ -232,27 +368,53 @@ def save_figure(image, mask, blobs, fname, blob_name, param_name, param_vals, sh
         plt.close(fig)
 
 
+_disk_stamps = {}
+
+
+def get_disk_stamp(r):
+    """Filled disk of radius r drawn by cv2.circle into an array of size 2 * r + 1, cached per radius."""
+    if r not in _disk_stamps:
+        stamp = np.zeros((2 * r + 1, 2 * r + 1), dtype=np.float32)
+        cv2.circle(stamp, (r, r), r, color=1, thickness=-1)
+        _disk_stamps[r] = stamp
+    return _disk_stamps[r]
+
+
+def draw_disks(acc, disks, weight=1):
+    """Adds filled disks (y, x, r) multiplied by weight to the accumulator in place. Every disk is a cached stamp
+    added to the disk's bounding box clipped to the accumulator, i.e. the same pixels as cv2.circle draws."""
+    rows, cols = acc.shape
+    for y, x, r in disks:
+        y, x, r = int(round(y)), int(round(x)), int(round(r))
+        if r < 0:
+            continue
+        stamp = get_disk_stamp(r)
+        r0, r1 = max(y - r, 0), min(y + r + 1, rows)
+        c0, c1 = max(x - r, 0), min(x + r + 1, cols)
+        if r0 >= r1 or c0 >= c1:
+            continue
+        stamp = stamp[r0 - (y - r):r1 - (y - r), c0 - (x - r):c1 - (x - r)]
+        if weight == 1:
+            acc[r0:r1, c0:c1] += stamp
+        else:
+            acc[r0:r1, c0:c1] += weight * stamp
+    return acc
+
+
 def calc_survival_fcn(blobs, mask, show=False, show_now=True):
-    surv_im = np.zeros(mask.shape)
+    # counting the disks covering every pixel, counts are exact in float32
+    counts = np.zeros(mask.shape, dtype=np.float32)
     n_imgs = len(blobs)
     surv_k = 1. / n_imgs
     for b_im in blobs:
-        for y, x, r in b_im:
-            tmp = np.zeros_like(surv_im)
-            # cv2.circle(tmp, (x, y), r, color=(1, 1, 1), thickness=-1)
-            try:
-                cv2.circle(tmp, (int(round(x)), int(round(y))), int(round(r)), color=1, thickness=-1)
-            except:
-                pass
-            tmp *= surv_k
-            surv_im += tmp
-
-            if show:
-                plt.figure()
-                plt.subplot(121), plt.imshow(surv_im, 'gray', interpolation='nearest'), plt.title('surv_im')
-                plt.subplot(122), plt.imshow(tmp, 'gray', interpolation='nearest'), plt.title('tmp')
-                if show_now:
-                    plt.show()
+        draw_disks(counts, b_im)
+    surv_im = surv_k * counts.astype(np.float)
+
+    if show:
+        plt.figure()
+        plt.imshow(surv_im, 'gray', interpolation='nearest'), plt.title('surv_im')
+        if show_now:
+            plt.show()
 
     return surv_im * mask
 
@@ -266,14 +428,16 @@ def compose_resp_im(image, blobs):
     return resp_im
 
 
-def detect_dog(image, mask, sigma_ratios, thresholds, overlaps):
+def detect_dog(image, mask, sigma_ratios, thresholds, overlaps, scale_space=None):
     dogs = []
+    if scale_space is None:
+        scale_space = ScaleSpace(check_blob_intensity(image, 'dark'))
 
     # SIGMA RATIO  ----------------------------------------------------
     dogs_sr = []
     for i in sigma_ratios:
         # _debug('Sigma ratio = %.1f' % i)
-        blobs = dog(image, mask=mask, intensity='dark', sigma_ratio=i)
+        blobs = dog(image, mask=mask, intensity='dark', sigma_ratio=i, scale_space=scale_space)
         dogs_sr.append(blobs)
         dogs.append(blobs)
 
@@ -281,7 +445,7 @@ def detect_dog(image, mask, sigma_ratios, thresholds, overlaps):
     dogs_t = []
     for i in thresholds:
         # _debug('Threshold = %.1f' % i)
-        blobs = dog(image, mask=mask, intensity='dark', threshold=i)
+        blobs = dog(image, mask=mask, intensity='dark', threshold=i, scale_space=scale_space)
         dogs_t.append(blobs)
         dogs.append(blobs)
 
@@ -295,20 +459,22 @@ def detect_dog(image, mask, sigma_ratios, thresholds, overlaps):
     return dogs, dogs_sr, dogs_t
 
 
-def detect_log(image, mask, num_sigmas, thresholds, overlaps, log_scales):
+def detect_log(image, mask, num_sigmas, thresholds, overlaps, log_scales, scale_space=None):
     logs = []
+    if scale_space is None:
+        scale_space = ScaleSpace(check_blob_intensity(image, 'dark'))
 
     # NUMBER OF SIGMAS  ----------------------------------------------------
     logs_ns = []
     for i in num_sigmas:
-        blobs = log(image, mask=mask, intensity='dark', num_sigma=i)
+        blobs = log(image, mask=mask, intensity='dark', num_sigma=i, scale_space=scale_space)
         logs_ns.append(blobs)
         logs.append(blobs)
 
     # THRESHOLD  ------------------------------------------------------
     logs_t = []
     for i in thresholds:
-        blobs = log(image, mask=mask, intensity='dark', threshold=i)
+        blobs = log(image, mask=mask, intensity='dark', threshold=i, scale_space=scale_space)
         logs_t.append(blobs)
         logs.append(blobs)
 
@@ -322,24 +488,25 @@ def detect_log(image, mask, num_sigmas, thresholds, overlaps, log_scales):
     # LOG SCALE  -------------------------------------------------------
     logs_ls = []
     for i in log_scales:
-        blobs = log(image, mask=mask, intensity='dark', log_scale=i)
+        blobs = log(image, mask=mask, intensity='dark', log_scale=i, scale_space=scale_space)
         logs_ls.append(blobs)
         logs.append(blobs)
 
     return logs, logs_ns, logs_t, logs_ls
 
 
-def detect_doh(image, mask, num_sigmas, thresholds, overlaps, log_scales):
+def detect_doh(image, mask, num_sigmas, thresholds, overlaps, log_scales, scale_space=None):
     dohs = []
 
-    if image.dtype.type in (np.float, np.float32, np.float64) and image.max() <= 1:
-        image = (255 * image).astype(np.uint8)
+    image = doh_image(image)
+    if scale_space is None:
+        scale_space = ScaleSpace(image)
 
     # NUMBER OF SIGMAS  ----------------------------------------------------
     dohs_ns = []
     for i in num_sigmas:
         # _debug('Num sigmas: %i' % i)
-        blobs = doh(image, mask=mask, intensity='dark', num_sigma=i)
+        blobs = doh(image, mask=mask, intensity='dark', num_sigma=i, scale_space=scale_space)
         # blobs = doh(image, mask=mask, intensity='bright', num_sigma=i)
         dohs_ns.append(blobs)
         dohs.append(blobs)
@@ -348,7 +515,7 @@ def detect_doh(image, mask, num_sigmas, thresholds, overlaps, log_scales):
     dohs_t = []
     for i in thresholds:
         # _debug('Threshold: %.3f' % i)
-        blobs = doh(image, mask=mask, intensity='dark', threshold=i)
+        blobs = doh(image, mask=mask, intensity='dark', threshold=i, scale_space=scale_space)
         # blobs = doh(image, mask=mask, intensity='bright', threshold=i)
         dohs_t.append(blobs)
         dohs.append(blobs)
@@ -414,7 +581,11 @@ def detect_opencv_detector(image, mask, min_thresholds, min_areas, min_circulari
     return blobs_all, blobs_mt, blobs_ma, blobs_mcir, blobs_mcon, blobs_mi
 
 
-def detect_blobs(image, mask, blob_type, layer_id, show=False, show_now=True, save_fig=False, fig_dir='.', verbose=True):
+def detect_blobs(image, mask, blob_type, layer_id, show=False, show_now=True, save_fig=False, fig_dir='.', verbose=True,
+                 scale_spaces=None):
+    """scale_spaces ... scale spaces of the image shared by all blob types, see create_scale_spaces()"""
+    if scale_spaces is None:
+        scale_spaces = create_scale_spaces(image)
     if blob_type == BLOB_DOG:
         # DOG detection -----------------
         # print 'DOG detection ...',
@@ -423,7 +594,8 @@ def detect_blobs(image, mask, blob_type, layer_id, show=False, show_now=True, sa
         sigma_ratios = np.arange(0.6, 2, 0.2)
         thresholds = np.arange(0.1, 1, 0.1)
         overlaps = np.arange(0, 1, 0.2)
-        blobs, blobs_sr, blobs_t = detect_dog(image, mask, sigma_ratios, thresholds, overlaps)
+        blobs, blobs_sr, blobs_t = detect_dog(image, mask, sigma_ratios, thresholds, overlaps,
+                                              scale_space=scale_spaces[BLOB_DOG])
         blobs_sr_surv = calc_survival_fcn(blobs_sr, mask)
         blobs_t_surv = calc_survival_fcn(blobs_t, mask)
         blobs_surv_overall = calc_survival_fcn(blobs, mask)
@@ -441,7 +613,8 @@ def detect_blobs(image, mask, blob_type, layer_id, show=False, show_now=True, sa
         # thresholds = np.array([0.02, 0.1])
         overlaps = np.arange(0, 1, 0.2)
         log_scales = [False, True]
-        blobs, blobs_ns, blobs_t, blobs_ls = detect_log(image, mask, num_sigmas, thresholds, overlaps, log_scales)
+        blobs, blobs_ns, blobs_t, blobs_ls = detect_log(image, mask, num_sigmas, thresholds, overlaps, log_scales,
+                                                        scale_space=scale_spaces[BLOB_LOG])
         blobs_ns_surv = calc_survival_fcn(blobs_ns, mask)
         blobs_t_surv = calc_survival_fcn(blobs_t, mask)
         blobs_ls_surv = calc_survival_fcn(blobs_ls, mask)
@@ -458,7 +631,8 @@ def detect_blobs(image, mask, blob_type, layer_id, show=False, show_now=True, sa
         thresholds = np.arange(0.001, 0.01, 0.002)#, 0.03, 0.04, 0.05, 0.1, 0.3, 0.5, 1]
         overlaps = np.arange(0, 1, 0.2)
         log_scales = [False, True]
-        blobs, blobs_ns, blobs_t, blobs_ls = detect_doh(image, mask, num_sigmas, thresholds, overlaps, log_scales)
+        blobs, blobs_ns, blobs_t, blobs_ls = detect_doh(image, mask, num_sigmas, thresholds, overlaps, log_scales,
+                                                        scale_space=scale_spaces[BLOB_DOH])
         blobs_ns_surv = calc_survival_fcn(blobs_ns, mask, show=False)
         blobs_t_surv = calc_survival_fcn(blobs_t, mask, show=False)
         # blobs_ls_surv = calc_survival_fcn(blobs_ls, mask, show=False)
@@ -10,6 +10,8 @@ else:
     print 'You need to import package imtools: https://github.com/mjirik/imtools'
     sys.exit(0)
 
+import multiprocessing as mp
+
 import matplotlib.pyplot as plt
 import numpy as np
 import skfmm
@@ -17,7 +19,8 @@ import skimage.restoration as skires
 import skimage.filters as skifil
 import skimage.exposure as skiexp
 
-def run(data, params, slice_idx=0, mask=None, weight=0.0001, show=False):
+def run(data, params, slice_idx=0, mask=None, weight=0.0001, voxel_size=None, stop_time=None, pseudo_3d=False,
+        n_jobs=None, show=False):
 
     vmin = params['win_level'] - params['win_width'] / 2
     vmax = params['win_level'] + params['win_width'] / 2
@@ -58,39 +61,106 @@ def run(data, params, slice_idx=0, mask=None, weight=0.0001, show=False):
     speed_hypo = speed_function_hypo(data, mask, mode, params['fat_int'], params['hypo_int'], params['alpha'], params['speed_hypo_denom'])
     speed_hyper = speed_function_hyper(data, mask, mode, params['min_speed'], params['high_int_const'], params['alpha'], params['speed_hypo_denom'])
 
+    # arrival times of the fronts starting at the boundaries of the initial regions
+    hypo_times = arrival_times(hypo_init, speed_hypo, voxel_size=voxel_size, stop_time=stop_time,
+                               pseudo_3d=pseudo_3d, n_jobs=n_jobs)
+    hyper_times = arrival_times(hyper_init, speed_hyper, voxel_size=voxel_size, stop_time=stop_time,
+                                pseudo_3d=pseudo_3d, n_jobs=n_jobs)
+
     if show:
         # slice_idx = 14
         plt.figure()
-        plt.subplot(231), plt.imshow(data[slice_idx,:,:], 'gray', vmin=vmin, vmax=vmax)
-        plt.subplot(232), plt.imshow(hypo_init[slice_idx,:,:], 'gray'), plt.title('hypo initial')
-        plt.subplot(235), plt.imshow(hyper_init[slice_idx,:,:], 'gray'), plt.title('hyper initial')
-        plt.subplot(233), plt.imshow(speed_hypo[slice_idx,:,:], 'gray'), plt.title('speed hypo')#, plt.colorbar()
-        plt.subplot(236), plt.imshow(speed_hyper[slice_idx,:,:], 'gray'), plt.title('speed hyper')#, plt.colorbar()
+        plt.subplot(241), plt.imshow(data[slice_idx,:,:], 'gray', vmin=vmin, vmax=vmax)
+        plt.subplot(242), plt.imshow(hypo_init[slice_idx,:,:], 'gray'), plt.title('hypo initial')
+        plt.subplot(246), plt.imshow(hyper_init[slice_idx,:,:], 'gray'), plt.title('hyper initial')
+        plt.subplot(243), plt.imshow(speed_hypo[slice_idx,:,:], 'gray'), plt.title('speed hypo')#, plt.colorbar()
+        plt.subplot(247), plt.imshow(speed_hyper[slice_idx,:,:], 'gray'), plt.title('speed hyper')#, plt.colorbar()
+        plt.subplot(244), plt.imshow(hypo_times[slice_idx,:,:], 'gray'), plt.title('arrival times hypo')
+        plt.subplot(248), plt.imshow(hyper_times[slice_idx,:,:], 'gray'), plt.title('arrival times hyper')
         plt.show()
 
-    return hypo_init, hyper_init, speed_hypo, speed_hyper
+    return hypo_init, hyper_init, speed_hypo, speed_hyper, hypo_times, hyper_times
+
+
+def travel_times(init_region, speed, dx=1., stop_time=None):
+    """Arrival times of the front starting at the boundary of init_region and moving with given speed.
+    Points with zero speed are excluded, points not reached (or reached after stop_time) are set to stop_time
+    (inf if stop_time is None), points of the initial region are set to 0.
+    If there is no front (the initial region is empty, covers everything or its boundary is masked out by zero speed),
+    all points outside the initial region are set to the fill value. Other errors of skfmm (invalid dx, shapes
+    of init_region and speed not matching, RuntimeError of the C extension) are propagated.
+    """
+    fill_val = np.inf if stop_time is None else stop_time
+    phi = np.ma.MaskedArray(np.where(init_region, -1., 1.), speed <= 0)
+    try:
+        times = skfmm.travel_time(phi, speed, dx=dx, narrow=0 if stop_time is None else stop_time)
+    except ValueError as e:
+        # skfmm raises ValueError also for invalid arguments
+        if 'zero contour' not in str(e):
+            raise
+        times = fill_val * np.ones(init_region.shape)
+    times = np.ma.filled(times, fill_val).astype(np.float32)
+    times[init_region > 0] = 0
+
+    return times
+
+
+def _travel_times_job(args):
+    return travel_times(*args)
+
+
+def arrival_times(init_region, speed, voxel_size=None, stop_time=None, pseudo_3d=False, n_jobs=None):
+    """Arrival times computed by fast marching, see travel_times().
+    inputs:
+        init_region ... initial region
+        speed ... speed function
+        voxel_size ... size of voxels used as grid spacing, defaults to 1 in all dimensions
+        stop_time ... the marching stops at this time (narrow band)
+        pseudo_3d ... whether to process slices independently, they are processed in a pool of n_jobs processes
+        n_jobs ... number of processes, defaults to the number of cpus, 1 means no pool
+    """
+    if voxel_size is None:
+        voxel_size = np.ones(init_region.ndim)
+    voxel_size = [float(x) for x in voxel_size]
+    if not pseudo_3d or init_region.ndim == 2:
+        return travel_times(init_region, speed, dx=voxel_size[-init_region.ndim:], stop_time=stop_time)
+
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+    jobs = [(region_s, speed_s, voxel_size[1:], stop_time) for region_s, speed_s in zip(init_region, speed)]
+    if n_jobs == 1:
+        times = map(_travel_times_job, jobs)
+    else:
+        pool = mp.Pool(n_jobs)
+        times = pool.map(_travel_times_job, jobs)
+        pool.close()
+        pool.join()
+
+    return np.array(times)
 
 
 def speed_function_hyper(data, mask, mode, min_speed, high_int_const, alpha, denom):
-    speed_lower = np.where(data <= mode, 1, 0)
-    speed_higher = np.where(data > mode, 1 - alpha * (data - mode) / denom, 0)
-    speed_signif_higher = np.where(data > mode + high_int_const, 0.2, 0)
-
-    speed = speed_lower + speed_higher + speed_signif_higher
+    # 1 for data <= mode, 1 - alpha * (data - mode) / denom for data > mode, + 0.2 for data > mode + high_int_const
+    speed = data.astype(np.float32)
+    speed -= mode
+    np.maximum(speed, 0, out=speed)
+    speed *= -float(alpha) / denom
+    speed += 1
+    speed[data > mode + high_int_const] += 0.2
     speed *= mask
 
     return speed
 
 
 def speed_function_hypo(data, mask, mode, fat_int, hypo_int, alpha, denom):
-    speed_bellow_fat = np.where(data <= fat_int, 1, 0)
-    speed_fat2hypo = np.where((data > fat_int)*(data <= hypo_int), \
-                                      1 - alpha * (data + hypo_int) / denom, 0)
-    speed_hypo2mode = np.where((data > hypo_int)*(data <= mode), \
-                                      1 - alpha * (mode - data) / (mode - hypo_int), 0)
-    speed_higher = np.where(data > mode, 1, 0)
-
-    speed = speed_bellow_fat + speed_fat2hypo + speed_hypo2mode + speed_higher
+    # 1 for data <= fat_int and data > mode,
+    # 1 - alpha * (data + hypo_int) / denom for fat_int < data <= hypo_int,
+    # 1 - alpha * (mode - data) / (mode - hypo_int) for hypo_int < data <= mode
+    speed = np.ones(data.shape, dtype=np.float32)
+    fat2hypo = (data > fat_int) & (data <= hypo_int)
+    speed[fat2hypo] -= alpha * (data[fat2hypo] + hypo_int) / float(denom)
+    hypo2mode = (data > hypo_int) & (data <= mode)
+    speed[hypo2mode] -= alpha * (mode - data[hypo2mode]) / float(mode - hypo_int)
     speed *= mask
 
     return speed
@@ -3,9 +3,11 @@ __author__ = 'tomas'
 
 import numpy as np
 import matplotlib.pyplot as plt
+import scipy.sparse as scisp
+import scipy.sparse.linalg as scisplin
 
 
-def run(data, params, n_steps=100, mask=None):
+def run(data, params, n_steps=100, mask=None, n_walkers=1, seed=None):
 
     debug = True
     # vmin = params['win_level'] - params['win_width'] / 2
@@ -19,10 +21,11 @@ def run(data, params, n_steps=100, mask=None):
     t_probs = trans_probs(data, nghb_idxs, nghb_ints)
 
     # visits = walk(t_probs, nghb_idxs, n_steps, start)
-    vis_1 = walk(t_probs, nghb_idxs, n_steps, 0).reshape(data.shape)
-    vis_2 = walk(t_probs, nghb_idxs, n_steps, data.shape[1]-1).reshape(data.shape)
-    vis_3 = walk(t_probs, nghb_idxs, n_steps, (data.shape[0])*(data.shape[1]-1)).reshape(data.shape)
-    vis_4 = walk(t_probs, nghb_idxs, n_steps, np.prod(data.shape)-1).reshape(data.shape)
+    # n_walkers walkers are started from each corner, the runs are reproducible if seed is given
+    corners = [0, data.shape[1]-1, (data.shape[0])*(data.shape[1]-1), np.prod(data.shape)-1]
+    seeds = [None if seed is None else seed + i for i in range(len(corners))]
+    vis_1, vis_2, vis_3, vis_4 = [walk_batch(t_probs, nghb_idxs, n_steps, [c] * n_walkers, seed=s).reshape(data.shape)
+                                  for c, s in zip(corners, seeds)]
 
     visits = (vis_1 + vis_2 + vis_3 + vis_4) / 4.
 
@@ -65,6 +68,127 @@ def walk(t_probs, nghb_idxs, n_steps, start):
     return visits
 
 
+def walk_batch(t_probs, nghb_idxs, n_steps, starts, seed=None, chunk_size=100):
+    """Simulates many walkers at once. In each step, directions of all walkers are sampled from the transition
+    probabilities in one vectorized operation.
+    inputs:
+        t_probs ... transition probabilities, ndarray [n_nghbs x n_pts]
+        nghb_idxs ... indices of neighbors, -1 for a missing neighbor, ndarray [n_nghbs x n_pts]
+        n_steps ... number of steps of each walker
+        starts ... starting points (linear indices) of the walkers
+        seed ... seed of the random generator
+        chunk_size ... number of steps after which visited points are accumulated
+    outputs:
+        visits ... number of visits of points (summed over the walkers), ndarray [n_pts]
+    """
+    rng = np.random.RandomState(seed)
+    n_nghbs, n_pts = t_probs.shape
+    cum_probs = np.cumsum(t_probs, 0)
+    curr_pts = np.array(starts, dtype=np.int)
+    n_walkers = len(curr_pts)
+
+    visits = np.zeros(n_pts, dtype=np.int64)
+    visited = np.zeros((chunk_size, n_walkers), dtype=np.int)
+    for i in range(n_steps):
+        # the first direction with cumulative probability higher than the random number
+        probs = rng.rand(n_walkers)
+        dirs = np.minimum((probs >= cum_probs[:, curr_pts]).sum(0), n_nghbs - 1)
+        next_pts = nghb_idxs[dirs, curr_pts]
+        # due to rounding errors a missing neighbor can be chosen, then the walker stays
+        curr_pts = np.where(next_pts >= 0, next_pts, curr_pts)
+
+        visited[i % chunk_size] = curr_pts
+        if (i + 1) % chunk_size == 0 or i == n_steps - 1:
+            visits += np.bincount(visited[:i % chunk_size + 1].ravel(), minlength=n_pts)
+
+    return visits
+
+
+def transition_matrix(t_probs, nghb_idxs):
+    """Assembles the transition matrix of the walk, P[i, j] is the probability of the step from i to j.
+    outputs:
+        P ... scipy.sparse.csr_matrix [n_pts x n_pts]
+    """
+    n_pts = t_probs.shape[1]
+    valid = nghb_idxs >= 0
+    rows = np.tile(np.arange(n_pts), (nghb_idxs.shape[0], 1))
+    P = scisp.csr_matrix((t_probs[valid], (rows[valid], nghb_idxs[valid])), shape=(n_pts, n_pts))
+    return P
+
+
+def expected_visits(P, start, n_steps):
+    """Exact expected number of visits of points during n_steps steps of a walker starting at start, i.e. the
+    limit of walk() averaged over many walkers. Calculated by n_steps sparse matrix-vector products.
+    """
+    PT = P.T.tocsr()
+    dist = np.zeros(P.shape[0])
+    dist[start] = 1
+    visits = np.zeros(P.shape[0])
+    for i in range(n_steps):
+        dist = PT.dot(dist)
+        visits += dist
+    return visits
+
+
+def stationary_distribution(P, tol=1e-10, max_iter=100000):
+    """Stationary distribution of the walk calculated by power iteration. The lazy chain (P + I) / 2, which has
+    the same stationary distribution, is iterated because the walk on a grid is periodic.
+    """
+    PT = P.T.tocsr()
+    dist = np.ones(P.shape[0]) / P.shape[0]
+    for i in range(max_iter):
+        dist_new = 0.5 * (dist + PT.dot(dist))
+        dist_new /= dist_new.sum()
+        if np.abs(dist_new - dist).sum() < tol:
+            return dist_new
+        dist = dist_new
+    return dist
+
+
+class AbsorbingChain:
+    """Walk absorbed in given points. The expected numbers of visits of transient points are given by the rows of
+    the fundamental matrix N = (I - Q)^-1, where Q is the transition matrix restricted to the transient points.
+    The LU factorization of (I - Q)^T is computed once and reused for all starting points.
+    inputs:
+        P ... transition matrix, see transition_matrix()
+        absorbing ... absorbing points, boolean mask or linear indices
+    """
+    def __init__(self, P, absorbing):
+        n_pts = P.shape[0]
+        absorbing_m = np.zeros(n_pts, dtype=np.bool)
+        absorbing_m[absorbing] = True
+        self.n_pts = n_pts
+        self.transient = np.flatnonzero(np.logical_not(absorbing_m))
+        self.transient_idx = -np.ones(n_pts, dtype=np.int)
+        self.transient_idx[self.transient] = np.arange(len(self.transient))
+
+        Q = P.tocsr()[self.transient, :][:, self.transient]
+        A = scisp.identity(len(self.transient), format='csc') - Q.T.tocsc()
+        self.lu = scisplin.splu(A.tocsc())
+
+    def visits(self, starts):
+        """Expected numbers of visits of points before absorption, counted after each step as in walk().
+        inputs:
+            starts ... starting point or list of starting points (linear indices of transient points)
+        outputs:
+            visits ... ndarray [n_pts] for a single start, [n_starts x n_pts] otherwise
+        """
+        single = np.isscalar(starts)
+        starts = np.atleast_1d(starts)
+        idxs = self.transient_idx[starts]
+        if (idxs < 0).any():
+            raise ValueError('Starting points must be transient.')
+        rhs = np.zeros((len(self.transient), len(starts)))
+        rhs[idxs, np.arange(len(starts))] = 1
+        sol = self.lu.solve(rhs)
+        # the fundamental matrix counts the start at time 0 as well
+        sol[idxs, np.arange(len(starts))] -= 1
+
+        visits = np.zeros((len(starts), self.n_pts))
+        visits[:, self.transient] = sol.T
+        return visits[0] if single else visits
+
+
 def get_direction(probs):
     prob = np.random.rand(1)[0]
     idx = -1
@@ -77,6 +201,8 @@ def get_direction(probs):
 
 
 def nghb_matrix(data):
+    if data.ndim == 3:
+        return nghb_matrix_3d(data)
     if data.ndim == 2:
         n_nghbs = 4
         n_cols = data.shape[1]
@@ -103,10 +229,28 @@ def nghb_matrix(data):
     return nghb_m, nghb_ints
 
 
+def nghb_matrix_3d(data):
+    # 6-neighborhood - upper, right, bottom and left neighbor in the slice, then the previous and the next slice
+    offsets = [(0, -1, 0), (0, 0, 1), (0, 1, 0), (0, 0, -1), (-1, 0, 0), (1, 0, 0)]
+    n_pts = data.size
+    lind = np.arange(n_pts).reshape(data.shape)
+    nghb_m = -np.ones((len(offsets), n_pts), dtype=np.int)
+    for i, offset in enumerate(offsets):
+        src = tuple(slice(max(-o, 0), s - max(o, 0)) for o, s in zip(offset, data.shape))
+        dst = tuple(slice(max(o, 0), s - max(-o, 0)) for o, s in zip(offset, data.shape))
+        nghb_m[i, lind[src].ravel()] = lind[dst].ravel()
+
+    # creating matrix of neighbors' intensities
+    data = data.ravel()
+    nghb_ints = np.where(nghb_m >= 0, data[nghb_m], -1)
+
+    return nghb_m, nghb_ints
+
+
 def trans_probs(data, nghb_idxs, nghb_ints):
     data = data.ravel()
     n_pts = np.prod(data.shape)
-    n_nghbs = 4
+    n_nghbs = nghb_idxs.shape[0]
     t_probs = nghb_ints.copy()
     nghbs_count = np.sum(nghb_idxs >= 0, 0)  # number of neighbors of current point
 
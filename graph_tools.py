@@ -4,30 +4,27 @@ import numpy as np
 import matplotlib.pyplot as plt
 import networkx as nx
 import skimage.segmentation as skiseg
-import skimage.morphology as skimor
-import scipy.ndimage.morphology as scindimor
 import cv2
 import scipy.ndimage.measurements as scindimea
+import scipy.sparse as scisp
+import scipy.sparse.csgraph as scicsg
+from collections import namedtuple
 
 
-def make_neighborhood_matrix(im, nghood=4, roi=None):
-    im = np.array(im, ndmin=3)
-    n_slices, n_rows, n_cols = im.shape
+SuppxlStats = namedtuple('SuppxlStats', ['count', 'sum', 'mean', 'min', 'max', 'var', 'bbox'])
 
-    # initialize ROI
-    if roi is None:
-        roi = np.ones(im.shape, dtype=np.bool)
 
-    # if len(im.shape) == 3:
-    #     nslices = im.shape[2]
-    # else:
-    #     nslices = 1
-    npts = n_rows * n_cols * n_slices
-    # print 'start'
+def get_nghood_offsets(nghood=4):
+    """Returns offsets of neighbors for given neighborhood.
+    inputs:
+        nghood ... type of neighborhood, 4 or 8 (in-plane) and 6 or 26 (3D)
+    outputs:
+        ns, nr, nc ... slice, row and column offsets of neighbors, ndarrays [nghood], None if wrong neighborhood
+    """
     if nghood == 8:
         nr = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
         nc = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
-        ns = np.zeros(nghood)
+        ns = np.zeros(nghood, dtype=np.int32)
     elif nghood == 4:
         nr = np.array([-1, 0, 0, 1])
         nc = np.array([0, -1, 1, 0])
@@ -35,7 +32,7 @@ def make_neighborhood_matrix(im, nghood=4, roi=None):
     elif nghood == 26:
         nr_center = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
         nc_center = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
-        nr_border = np.zeros([-1, -1, -1, 0, 0, 0, 1, 1, 1])
+        nr_border = np.array([-1, -1, -1, 0, 0, 0, 1, 1, 1])
         nc_border = np.array([-1, 0, 1, -1, 0, 1, -1, 0, 1])
         nr = np.array(np.hstack((nr_border, nr_center, nr_border)))
         nc = np.array(np.hstack((nc_border, nc_center, nc_border)))
@@ -49,34 +46,90 @@ def make_neighborhood_matrix(im, nghood=4, roi=None):
         nc = np.array(np.hstack((nc_border, nc_center, nc_border)))
         ns = np.array(np.hstack((-np.ones_like(nr_border), np.zeros_like(nr_center), np.ones_like(nr_border))))
     else:
-        print 'Wrong neighborhood passed. Exiting.'
         return None
+    return ns, nr, nc
+
+
+def shift_slices(shape, offset):
+    """Returns slices selecting points and their neighbors given by offset, both restricted to points
+    having the neighbor inside the array.
+    """
+    src = tuple(slice(max(-o, 0), s - max(o, 0)) for o, s in zip(offset, shape))
+    dst = tuple(slice(max(o, 0), s - max(-o, 0)) for o, s in zip(offset, shape))
+    return src, dst
+
+
+def get_nghb_pairs(shape, nghood=4, roi=None):
+    """Generator of neighboring points. For each neighbor offset yields linear indices of points and of their
+    neighbors lying in the roi, both as int32 ndarrays.
+    """
+    offsets = get_nghood_offsets(nghood)
+    if offsets is None:
+        raise ValueError('Wrong neighborhood passed.')
+    lind = np.arange(np.prod(shape), dtype=np.int32).reshape(shape)
+    for offset in zip(*offsets):
+        src, dst = shift_slices(shape, offset)
+        if roi is None:
+            yield lind[src].ravel(), lind[dst].ravel()
+        else:
+            valid = roi[src] & roi[dst]
+            yield lind[src][valid], lind[dst][valid]
+
+
+def make_neighborhood_matrix(im, nghood=4, roi=None):
+    im = np.array(im, ndmin=3)
+    npts = im.size
+
+    # initialize ROI
+    if roi is None:
+        roi = np.ones(im.shape, dtype=np.bool)
+    roi = np.array(roi, ndmin=3, dtype=np.bool)
 
-    lind = np.ravel_multi_index(np.indices(im.shape), im.shape)  # linear indices in array form
-    lindv = np.reshape(lind, npts)  # linear indices in vector form
-    coordsv = np.array(np.unravel_index(lindv, im.shape))  # coords in array [dim * nvoxels]
+    if get_nghood_offsets(nghood) is None:
+        print 'Wrong neighborhood passed. Exiting.'
+        return None
 
+    # points outside the roi have zeros, missing neighbors of points inside the roi are NaN
     neighbors_m = np.zeros((nghood, npts))
-    for i in range(npts):
-        s, r, c = tuple(coordsv[:, i])
-        # if point doesn't lie in the roi then continue with another one
-        if not roi[s, r, c]:
-            continue
-        for nghb in range(nghood):
-            rn = r + nr[nghb]
-            cn = c + nc[nghb]
-            sn = s + ns[nghb]
-            row_ko = rn < 0 or rn > (n_rows - 1)
-            col_ko = cn < 0 or cn > (n_cols - 1)
-            slice_ko = sn < 0 or sn > (n_slices - 1)
-            if row_ko or col_ko or slice_ko or not roi[sn, rn, cn]:
-                neighbors_m[nghb, i] = np.NaN
-            else:
-                indexN = np.ravel_multi_index((sn, rn, cn), im.shape)
-                neighbors_m[nghb, i] = indexN
+    neighbors_m[:, roi.ravel()] = np.NaN
+    for i, (idxs, nghbs) in enumerate(get_nghb_pairs(im.shape, nghood, roi)):
+        neighbors_m[i, idxs] = nghbs
 
     return neighbors_m
 
+
+def make_neighborhood_csr(im, nghood=4, roi=None):
+    """Creates adjacency of points in CSR format, neighbors of the i-th point are indices[indptr[i]:indptr[i + 1]],
+    ordered in the same way as in make_neighborhood_matrix. Points outside the roi have no neighbors.
+    inputs:
+        im ... input image or volume, only its shape is used
+        nghood ... type of neighborhood, 4, 8, 6 or 26
+        roi ... region of interest, ndarray of the same shape as im
+    outputs:
+        indptr ... row pointers, int32 ndarray [npts + 1]
+        indices ... neighbors, int32 ndarray [number of edges]
+    """
+    im = np.array(im, ndmin=3)
+    npts = im.size
+    if roi is not None:
+        roi = np.array(roi, ndmin=3, dtype=np.bool)
+
+    # number of neighbors of every point
+    degs = np.zeros(npts, dtype=np.int32)
+    for idxs, _ in get_nghb_pairs(im.shape, nghood, roi):
+        degs[idxs] += 1
+    indptr = np.zeros(npts + 1, dtype=np.int32)
+    np.cumsum(degs, out=indptr[1:])
+
+    # filling the neighbors, degs is reused as a counter of already filled neighbors
+    indices = np.zeros(indptr[-1], dtype=np.int32)
+    degs[:] = 0
+    for idxs, nghbs in get_nghb_pairs(im.shape, nghood, roi):
+        indices[indptr[idxs] + degs[idxs]] = nghbs
+        degs[idxs] += 1
+
+    return indptr, indices
+
 def graph2img( g, size):
     im = np.zeros(size, dtype=np.bool)
     nodes = g.nodes()
@@ -84,44 +137,93 @@ def graph2img( g, size):
     im[nodes_coords[0, :], nodes_coords[1, :]] = 1
     return im
 
+def edge_weights(ints1, ints2, wtype=1, sigma=10):
+    """Calculates weights of edges between points with intensities ints1 and ints2.
+    wtype ... 1 = 1 / exp(-|d| / sigma), 2 = 1 / exp(-d^2 / (2 * sigma^2)), otherwise |d|
+    """
+    diff = np.absolute(ints1.astype(np.float) - ints2)
+    if wtype == 1:
+        w = np.exp(diff / sigma)  # w1
+    elif wtype == 2:
+        w = np.exp(diff**2 / (2 * sigma**2))  # w2
+    else:
+        w = diff  # w3
+    return w
+
+def create_graph_sparse(im, nghood=4, wtype=1, roi=None):
+    """Creates weighted graph of image points stored as sparse adjacency matrix.
+    inputs:
+        im ... input image or volume
+        nghood ... type of neighborhood, see make_neighborhood_csr()
+        wtype ... type of edge weights, see edge_weights()
+        roi ... region of interest, points outside have no edges
+    outputs:
+        G ... symmetric adjacency matrix with edge weights, scipy.sparse.csr_matrix [npts x npts],
+              explicit zeros are valid edges (wtype=3)
+    """
+    indptr, indices = make_neighborhood_csr(im, nghood, roi)
+    n_nodes = len(indptr) - 1
+    imv = np.reshape(im, n_nodes)
+    rows = np.repeat(np.arange(n_nodes, dtype=np.int32), np.diff(indptr))
+    w = edge_weights(imv[rows], imv[indices], wtype)
+    return scisp.csr_matrix((w, indices, indptr), shape=(n_nodes, n_nodes))
+
+def sparse2nx(G):
+    """Exports graph stored as sparse adjacency matrix to networkx graph."""
+    return nx.from_scipy_sparse_matrix(G, edge_attribute='weight')
+
 def create_graph( im, nghood=4, wtype=1, talk_to_me=True ):
     if talk_to_me:
         print 'Creating graph...'
-        print '\t- constructing neighborhood matrix ...',
-    nghb_m = make_neighborhood_matrix(im, nghood)
-    if talk_to_me:
-        print 'ok'
-    n_nodes = nghb_m.shape[1]
-    imv = np.reshape(im, n_nodes).astype(float)
-    G = nx.Graph()
-    #adding nodes
-    if talk_to_me:
-        print '\t- adding nodes ...',
-    G.add_nodes_from(range(n_nodes))
+        print '\t- constructing sparse graph ...',
+    G = create_graph_sparse(im, nghood, wtype)
     if talk_to_me:
         print 'ok'
-    #adding edges
-    #sigma = imv.max() - imv.min()
-    sigma = 10
-    if talk_to_me:
-        print '\t- adding edges ...',
-    for n in range(n_nodes):
-        for i in range(1, nghood):
-            nghb = nghb_m[i, n]
-            if np.isnan(nghb):
-                continue
-            if wtype == 1:
-                w = 1. / np.exp(- np.absolute(imv[n] - imv[nghb]) / sigma) #w1
-            elif wtype == 2:
-                w = 1. / np.exp(- (imv[n] - imv[nghb])**2 / (2 * sigma**2)) #w2
-            else:
-                w = np.absolute(imv[n] - imv[nghb]) #w3
-            G.add_edge(n, int(nghb), {'weight':w})
+        print '\t- exporting to networkx ...',
+    G = sparse2nx(G)
     if talk_to_me:
         print 'ok'
         print '...done.'
     return G
 
+def get_suppxl_stats(im, suppxls):
+    """Calculates statistics of all superpixels at once, labels are expected to be 0, 1, ..., n_suppxls - 1.
+    Statistics of an empty superpixel are NaN (min and max are 0), its bbox is None.
+    inputs:
+        im ... grayscale image or volume, ndarray
+        suppxls ... image with suppxls labels, ndarray - same size as im
+    outputs:
+        stats ... SuppxlStats with count, sum, mean, min, max and variance of intensities, ndarrays [n_suppxls],
+                  and list of bounding boxes (tuples of slices)
+    """
+    n_suppxls = suppxls.max() + 1
+    labels = suppxls.ravel()
+    ints = im.ravel().astype(np.float)
+
+    counts = np.bincount(labels, minlength=n_suppxls)
+    sums = np.bincount(labels, weights=ints, minlength=n_suppxls)
+    sums_sq = np.bincount(labels, weights=ints**2, minlength=n_suppxls)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+        variances = np.maximum(sums_sq / counts - means**2, 0)
+    idxs = np.arange(n_suppxls)
+    mins = np.array(scindimea.minimum(ints, labels, idxs))
+    maxs = np.array(scindimea.maximum(ints, labels, idxs))
+    bboxes = scindimea.find_objects(suppxls + 1, max_label=n_suppxls)
+
+    return SuppxlStats(count=counts, sum=sums, mean=means, min=mins, max=maxs, var=variances, bbox=bboxes)
+
+def relabel_suppxls(suppxls):
+    """Relabels superpixels to consecutive labels 0, 1, ..., n_suppxls - 1 preserving their order.
+    inputs:
+        suppxls ... image with suppxls labels, ndarray
+    outputs:
+        new_supps ... image with new suppxls labels, ndarray - same size as suppxls
+        labels ... original labels, new_supps == i corresponds to suppxls == labels[i]
+    """
+    labels, new_supps = np.unique(suppxls, return_inverse=True)
+    return new_supps.reshape(suppxls.shape), labels
+
 def get_suppxl_ints(im, suppxls):
     """Calculates mean intensities of pixels in superpixels
     inputs:
@@ -130,22 +232,8 @@ def get_suppxl_ints(im, suppxls):
     outputs:
         suppxl_intens ... image with suppxls mean intensities, ndarray [MxN]-same size as im
     """
-    n_suppxl = suppxls.max() + 1
-    # suppxl_intens = np.zeros(n_suppxl)
-    suppxl_ints = np.zeros(suppxls.shape)
-
-    for i in range(n_suppxl):
-        sup = suppxls == i
-        vals = im[np.nonzero(sup)]
-        # try:
-        #     suppxl_intens[i] = np.mean(vals)
-        # except:
-        #     suppxl_intens[i] = -1
-        val = np.mean(vals)
-        # suppxl_int[np.nonzero(sup)] = suppxl_intens[i]
-        suppxl_ints[np.nonzero(sup)] = val
-
-    return suppxl_ints
+    # the means are broadcasted back through a lookup table
+    return get_suppxl_stats(im, suppxls).mean[suppxls]
 
 def remove_empty_suppxls(suppxls):
     """Remove empty superpixels. Sometimes there are superpixels(labels), which are empty. To overcome subsequent
@@ -155,64 +243,67 @@ def remove_empty_suppxls(suppxls):
     outputs:
         new_supps ... image with suppxls labels, ndarray [MxN]-same size as im, empty superpixel labels are removed
     """
+    return relabel_suppxls(suppxls)[0]
+
+def get_suppxls_rag(suppxls, im=None, roi=None, connectivity=None):
+    """Creates region adjacency graph of superpixels in one pass. The label image is compared with its shifted
+    copies, pairs of different labels are collected and deduplicated.
+    inputs:
+        suppxls ... image with suppxls labels, ndarray (2D or 3D)
+        im ... image of intensities used for boundary contrast, ndarray - same size as suppxls
+        roi ... region of interest, only pixel pairs lying inside are considered
+        connectivity ... maximal number of orthogonal steps to reach a neighbor, 1 for shifts along the axes only,
+                         defaults to suppxls.ndim, i.e. 8-neighborhood in 2D and 26-neighborhood in 3D
+    outputs:
+        edges ... pairs of neighboring labels (a < b), ndarray [n_edges x 2]
+        bnd_lens ... boundary lengths, i.e. numbers of neighboring pixel pairs, ndarray [n_edges]
+        contrasts ... mean absolute intensity differences of neighboring pixel pairs, ndarray [n_edges],
+                      None if im is not given
+    """
+    if connectivity is None:
+        connectivity = suppxls.ndim
+    # each pair of pixels is considered only once -> the first nonzero coordinate of the offset is positive
+    offsets = [o for o in np.ndindex((3,) * suppxls.ndim)]
+    offsets = [tuple(x - 1 for x in o) for o in offsets]
+    offsets = [o for o in offsets if 0 < np.count_nonzero(o) <= connectivity and o[np.flatnonzero(o)[0]] > 0]
+
     n_suppxls = suppxls.max() + 1
-    new_supps = np.zeros(suppxls.shape, dtype=np.integer)
-    idx = 0
-    for i in range(n_suppxls):
-        sup = suppxls == i
-        if sup.sum() > 0:
-            new_supps[np.nonzero(sup)] = idx
-            idx += 1
-    return new_supps
+    keys = []
+    diffs = []
+    for offset in offsets:
+        src, dst = shift_slices(suppxls.shape, offset)
+        lbls1 = suppxls[src]
+        lbls2 = suppxls[dst]
+        bnd = lbls1 != lbls2
+        if roi is not None:
+            bnd &= roi[src] & roi[dst]
+        lbls1 = lbls1[bnd].astype(np.int64)
+        lbls2 = lbls2[bnd].astype(np.int64)
+        keys.append(np.minimum(lbls1, lbls2) * n_suppxls + np.maximum(lbls1, lbls2))
+        if im is not None:
+            diffs.append(np.absolute(im[src][bnd].astype(np.float) - im[dst][bnd]))
+
+    keys, inv = np.unique(np.concatenate(keys), return_inverse=True)
+    edges = np.array((keys // n_suppxls, keys % n_suppxls)).T
+    bnd_lens = np.bincount(inv, minlength=len(keys))
+    if im is not None:
+        contrasts = np.bincount(inv, weights=np.concatenate(diffs), minlength=len(keys)) / np.maximum(bnd_lens, 1)
+    else:
+        contrasts = None
+
+    return edges, bnd_lens, contrasts
 
 def make_neighborhood_matrix_from_suppxls(suppxls, suppxls_ints, roi=None):
+    """Returns list of sorted arrays of neighboring labels for each superpixel, see get_suppxls_rag()."""
+    n_suppxls = suppxls.max() + 1
+    edges = get_suppxls_rag(suppxls, roi=roi)[0]
 
-    # initialize ROI
-    if roi is None:
-        roi = np.ones(suppxls.shape, dtype=np.bool)
+    # both directions of edges sorted by the first label and split to lists
+    edges = np.vstack((edges, edges[:, ::-1]))
+    edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+    splits = np.cumsum(np.bincount(edges[:, 0], minlength=n_suppxls))[:-1]
+    nghb_m = np.split(edges[:, 1], splits)
 
-    n_suppxls = suppxls.max() + 1
-    nghb_m = list()
-    # inside = np.zeros(suppxls.shape, dtype=np.uint8)
-    # outside = np.zeros(suppxls.shape, dtype=np.uint8)
-    for i in range(n_suppxls):
-        suppxl = suppxls == i
-        # if suppxl doesn't lie in the roi, continue with another one
-        if np.any(suppxl * roi):
-            if suppxl.ndim == 2:
-                suppxl_dil = skimor.binary_dilation(suppxl, skimor.square(3))
-            else:
-                suppxl_dil = scindimor.binary_dilation(suppxl, np.ones((3, 3, 3)))
-
-            # mask the roi
-            suppxl_dil *= roi
-
-            # get the dilation band
-            surround = suppxl_dil - suppxl
-
-            labels = np.unique(suppxls[np.nonzero(surround)])
-            # inside += (i+1) * suppxl
-
-            # print labels
-            # plt.figure()
-            # plt.subplot(121), plt.imshow(suppxl), plt.colorbar()
-            # plt.subplot(122), plt.imshow((suppxls+1) * surround, interpolation='nearest'), plt.colorbar()
-            # plt.show()
-        else:
-            labels = []
-            # outside += (i+1) * suppxl
-        nghb_m.append(labels)
-    # inside = skimor.label(inside, neighbors=8, background=0)
-    # outside = skimor.label(outside, neighbors=8, background=0)
-    # print 'inside: ', inside.max() + 1
-    # print 'outside: ', outside.max() + 1
-    # print 'n suppxls: ', n_suppxls
-    # plt.figure()
-    # plt.subplot(121), plt.imshow(inside, interpolation='nearest')
-    # plt.subplot(122), plt.imshow(outside, interpolation='nearest')
-    # plt.figure()
-    # plt.imshow(suppxls, interpolation='nearest')
-    # plt.show()
     return nghb_m
 
 def create_graph_from_suppxls(im, wtype=3, roi=None, suppxl_ints=None, suppxls=None, n_segments=100, compactness=10):
@@ -231,42 +322,25 @@ def create_graph_from_suppxls(im, wtype=3, roi=None, suppxl_ints=None, suppxls=N
     n_nodes = suppxls.max() + 1
 
     # creating vector of superpixel intensities: suppxl_ints_v[suppxl index] = intensity
-    suppxl_ints_v = np.zeros(n_nodes, dtype=np.int)
-    for i in range(n_nodes):
-        suppxl = suppxls == i
-        ints = suppxl_ints[np.nonzero(suppxl)]
-        if len(np.unique(ints)) == 1:
-            val = ints[0]
-        else:
-            print 'Warning! A superpixel has two different intensities.'
-            val = np.mean(ints)
-        suppxl_ints_v[i] = val
+    stats = get_suppxl_stats(suppxl_ints, suppxls)
+    if (stats.min != stats.max).any():
+        print 'Warning! A superpixel has two different intensities.'
+    suppxl_ints_v = np.where(stats.min == stats.max, stats.min, stats.mean).astype(np.int)
 
-    # neighbothood matrix
-    nghb_m = make_neighborhood_matrix_from_suppxls(suppxls, suppxl_ints, roi)
+    # region adjacency graph
+    edges, bnd_lens, contrasts = get_suppxls_rag(suppxls, im=im, roi=roi)
 
     G = nx.Graph()
 
-    # n_nodes = len(nghb_m) - nghb_m.count([])
-    n_nodes = len(nghb_m)  # this is OK if suppxls are relabeled
-
     # adding nodes
-    G.add_nodes_from(range(n_nodes))
+    G.add_nodes_from(range(n_nodes))  # this is OK if suppxls are relabeled
 
     # adding edges
-    sigma = 10
-
-    for n in range(n_nodes):
-        nghbs = nghb_m[n]
-        for i in range(len(nghbs)):
-            nghb = nghbs[i]
-            if wtype == 1:
-                w = 1. / np.exp(- np.absolute(suppxl_ints_v[n] - suppxl_ints_v[nghb]) / sigma)  # w1
-            elif wtype == 2:
-                w = 1. / np.exp(- (suppxl_ints_v[n] - suppxl_ints_v[nghb])**2 / (2 * sigma**2))  # w2
-            else:
-                w = np.absolute(suppxl_ints_v[n] - suppxl_ints_v[nghb])  # w3
-            G.add_edge(n, nghb, {'weight': w})
+    if wtype == 4:
+        w = contrasts  # mean contrast along the boundary
+    else:
+        w = edge_weights(suppxl_ints_v[edges[:, 0]], suppxl_ints_v[edges[:, 1]], wtype)
+    G.add_weighted_edges_from(zip(edges[:, 0].tolist(), edges[:, 1].tolist(), w.tolist()))
 
     return G, suppxls
 
@@ -300,6 +374,95 @@ def splitMST(T, getimg=False, imshape=(0,0)):
     else:
         return cclist
 
+class MSTHierarchy:
+    """Hierarchical segmentation given by minimum spanning tree of a graph. The sequence of splits of repeated
+    splitMST is found in one pass over the tree edges sorted by weight (the heaviest edge of positive weight whose
+    endpoints are not leafs of the current forest, as an edge once incident to a leaf stays so). Reversed, it gives
+    the merge order from which the whole dendrogram is built using union-find. Splitting to n segments (the first
+    n - 1 splits of splitMST) is then just a cut of the dendrogram. If more segments are requested than splitMST can
+    give, the remaining edges are removed heaviest first.
+    inputs:
+        G ... weighted graph, scipy.sparse matrix or networkx graph with nodes 0, 1, ..., n_nodes - 1
+    """
+    def __init__(self, G):
+        if not scisp.issparse(G):
+            G = nx.to_scipy_sparse_matrix(G, nodelist=range(G.number_of_nodes()))
+        G = scisp.csr_matrix(G, dtype=np.float, copy=True)
+        self.n_nodes = G.shape[0]
+
+        # zero weights are not considered as edges by minimum_spanning_tree
+        G.data[G.data == 0] = np.finfo(np.float).tiny
+        T = scicsg.minimum_spanning_tree(G).tocoo()
+        T.data[T.data == np.finfo(np.float).tiny] = 0
+        us = np.minimum(T.row, T.col)
+        vs = np.maximum(T.row, T.col)
+
+        # splits of splitMST, the heaviest edge first (ties in the order of its adjacency scan)
+        order = np.lexsort((vs, us, -T.data))
+        degs = np.bincount(np.hstack((us, vs)), minlength=self.n_nodes).tolist()
+        is_split = np.zeros(len(order), dtype=np.bool)
+        for i, u, v, w in zip(order.tolist(), us[order].tolist(), vs[order].tolist(), T.data[order].tolist()):
+            if w > 0 and degs[u] > 1 and degs[v] > 1:
+                is_split[i] = True
+                degs[u] -= 1
+                degs[v] -= 1
+        order = np.hstack((order[is_split[order]], order[~is_split[order]]))[::-1]
+        self.edges = np.array((us[order], vs[order])).T
+        self.weights = T.data[order]
+        self.n_merges = len(self.weights)
+
+        # dendrogram, the k-th merge joins clusters linkage[k, 0] and linkage[k, 1] into the cluster n_nodes + k
+        self.linkage = np.zeros((self.n_merges, 2), dtype=np.int)
+        self.sizes = np.ones(self.n_nodes + self.n_merges, dtype=np.int)
+        parents = range(self.n_nodes + self.n_merges)
+
+        def find(x):
+            root = x
+            while parents[root] != root:
+                root = parents[root]
+            while parents[x] != root:
+                parents[x], x = root, parents[x]
+            return root
+
+        for k, (u, v) in enumerate(self.edges.tolist()):
+            ru = find(u)
+            rv = find(v)
+            new = self.n_nodes + k
+            parents[ru] = new
+            parents[rv] = new
+            self.linkage[k] = (ru, rv)
+            self.sizes[new] = self.sizes[ru] + self.sizes[rv]
+
+    def get_n_merges(self, n_segments):
+        # number of merges giving n_segments segments, at least the number of connected components is returned
+        return int(np.clip(self.n_nodes - n_segments, 0, self.n_merges))
+
+    def get_labels(self, n_segments):
+        """Returns labels of nodes for the cut of the dendrogram to n_segments segments, ndarray [n_nodes]."""
+        m = self.get_n_merges(n_segments)
+        T = scisp.csr_matrix((np.ones(m), (self.edges[:m, 0], self.edges[:m, 1])), shape=(self.n_nodes, self.n_nodes))
+        return scicsg.connected_components(T, directed=False)[1]
+
+    def get_costs(self, n_segments, labels=None):
+        """Returns scores of segments in the same way as getGraphCost() of the components given by splitMST,
+        i.e. mean weight of tree edges inside the segment (0 for a single node segment).
+        outputs:
+            costs ... costs[i] is the score of segment labels == i, ndarray [n_segments]
+        """
+        m = self.get_n_merges(n_segments)
+        if labels is None:
+            labels = self.get_labels(n_segments)
+        n_labels = labels.max() + 1
+        edge_lbls = labels[self.edges[:m, 0]]
+        wsums = np.bincount(edge_lbls, weights=self.weights[:m], minlength=n_labels)
+        n_edges = np.bincount(edge_lbls, minlength=n_labels)
+        return np.where(n_edges > 0, wsums / np.maximum(n_edges, 1), 0)
+
+    def cut(self, n_segments):
+        """Returns labels of nodes and costs of segments for the cut to n_segments segments."""
+        labels = self.get_labels(n_segments)
+        return labels, self.get_costs(n_segments, labels)
+
 def getGraphCost(G):
     wsum = 0
     for u, v, edata in G.edges(data=True):
@@ -314,6 +477,12 @@ def getGraphCost(G):
     return score
 
 def get_graph_dists(g, seed, maxd, shape):
+    # graph stored as sparse matrix
+    if scisp.issparse(g):
+        dists = scicsg.dijkstra(g, indices=seed, limit=maxd)
+        dists[np.isinf(dists)] = 0
+        return dists.reshape(shape)
+
     #compute dists in graph from current seed
     dists, path = nx.single_source_dijkstra(g, seed, cutoff=maxd)
     dists_items_array = np.array(dists.items())
@@ -331,6 +500,19 @@ def get_shopabas(G, seed, data_shape, max_d=10, init_dist_val=None, suppxls=None
 
     n_pts = np.prod(data_shape)
 
+    # graph stored as sparse matrix
+    if scisp.issparse(G):
+        dists = scicsg.dijkstra(G, indices=seed, limit=max_d)
+        reached = np.isfinite(dists)
+        energy_s = np.where(reached, max_d - dists, 0)
+        dist_layer = np.where(reached, dists, init_dist_val)
+        if using_superpixels:
+            energy_s = energy_s[suppxls].flatten()
+            dist_layer = dist_layer[suppxls]
+        else:
+            dist_layer = dist_layer.reshape(data_shape)
+        return dist_layer, energy_s
+
     # urceni vzdalenosti od noveho seedu
     dists, _ = nx.single_source_dijkstra(G, seed, cutoff=max_d)
 
@@ -10,6 +10,8 @@ import cv2
 
 import sys
 import os
+import Queue
+import multiprocessing.pool as mppool
 
 import scipy.ndimage.filters as scindifil
 import skimage.transform as skitra
@@ -28,36 +30,135 @@ else:
     sys.exit(0)
 
 
-import matlab.engine
-import matlab
-
-
-def run(im, init_mask, method, slice=0, max_iter=1000, rad=20, alpha=0.1, energy_type=2, display=False, show=False, show_now=True):
-    # print 'starting matlab engine ...',
-    eng = matlab.engine.start_matlab()
-
-    im_matlab = matlab.uint8(im.tolist())
-    mask_matlab = matlab.logical(init_mask.tolist())
-
-    # plt.figure()
-    # plt.subplot(221), plt.imshow(im, 'gray')
-    # plt.subplot(222), plt.imshow(im_matlab, 'gray')
-    # plt.subplot(223), plt.imshow(init_mask, 'gray')
-    # plt.subplot(224), plt.imshow(mask_matlab, 'gray')
-    # plt.show()
-
-    # print 'segmenting ...',
-    if method == 'lls':
-        eng.addpath('localized_seg')
-        seg = eng.localized_seg(im_matlab, mask_matlab, max_iter, float(rad), alpha, energy_type, display, nargout=1)
-    elif method == 'sfm':
-        eng.addpath('sfm_chanvese_demo')
-        # eng.sfm_local_demo(nargout=0)
-        seg = eng.sfm_local_chanvese(im_matlab, mask_matlab, max_iter, alpha, float(rad), display, nargout=1)
+try:
+    import matlab.engine
+    import matlab
+except ImportError:
+    matlab = None
+
+import sfm_chanvese
+
+
+def to_matlab(arr, mtype):
+    """Converts an array to a matlab array of given type (e.g. matlab.uint8). The array is passed as a typed buffer,
+    engines older than R2022a do not accept it and get nested lists."""
+    try:
+        return mtype(np.ascontiguousarray(arr))
+    except (TypeError, ValueError):
+        return mtype(arr.tolist())
+
+
+def from_matlab(marr):
+    """Converts a matlab array to ndarray without going through python lists."""
+    # matlab stores the data in column-major order
+    return np.frombuffer(marr._data, dtype=marr._data.typecode).reshape(marr._size[::-1]).T
+
+
+class MatlabBackend:
+    """Matlab engine session with both implementations on the path."""
+    def __init__(self):
+        if matlab is None:
+            raise ImportError('Matlab engine for python is not installed.')
+        self.eng = matlab.engine.start_matlab()
+        self.eng.addpath('localized_seg')
+        self.eng.addpath('sfm_chanvese_demo')
+
+    def segment(self, im, init_mask, method, max_iter=1000, rad=20, alpha=0.1, energy_type=2, display=False):
+        im_matlab = to_matlab(im.astype(np.uint8), matlab.uint8)
+        mask_matlab = to_matlab(init_mask.astype(np.bool), matlab.logical)
+        if method == 'lls':
+            seg = self.eng.localized_seg(im_matlab, mask_matlab, max_iter, float(rad), alpha, energy_type, display,
+                                         nargout=1)
+        elif method == 'sfm':
+            seg = self.eng.sfm_local_chanvese(im_matlab, mask_matlab, max_iter, alpha, float(rad), display,
+                                              nargout=1)
+        else:
+            return init_mask.copy()
+        return from_matlab(seg)
+
+    def close(self):
+        self.eng.quit()
+
+
+class LocalBackend:
+    """Stand-in for MatlabBackend running in python, both methods use the sparse field localized Chan-Vese."""
+    def segment(self, im, init_mask, method, max_iter=1000, rad=20, alpha=0.1, energy_type=2, display=False):
+        if method not in ['lls', 'sfm']:
+            return init_mask.copy()
+        return sfm_chanvese.run(im, init_mask, max_iter=max_iter, rad=rad, alpha=alpha)
+
+    def close(self):
+        pass
+
+
+class SessionPool:
+    """Pool of warm backend sessions handed out to concurrent segmentation jobs. A session that fails is closed and
+    replaced by a new one and the job is retried.
+    inputs:
+        backend ... class of the sessions, MatlabBackend or LocalBackend
+        n_sessions ... number of sessions
+        max_retries ... how many times a failed job is retried
+    """
+    def __init__(self, backend=MatlabBackend, n_sessions=2, max_retries=1):
+        self.backend = backend
+        self.n_sessions = n_sessions
+        self.max_retries = max_retries
+        self.n_restarts = 0
+        self.sessions = Queue.Queue()
+        for i in range(n_sessions):
+            self.sessions.put(backend())
+
+    def discard(self, session):
+        try:
+            session.close()
+        except Exception:
+            pass
+
+    def run(self, im, init_mask, method, **params):
+        """Segments an image with the first free session, see MatlabBackend.segment(). A failed session is never
+        returned to the pool, its slot stays empty (None) until a job starts a new session in it."""
+        session = self.sessions.get()
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if session is None:
+                        self.n_restarts += 1
+                        session = self.backend()
+                    return session.segment(im, init_mask, method, **params)
+                except Exception:
+                    if session is not None:
+                        self.discard(session)
+                        session = None
+                    if attempt == self.max_retries:
+                        raise
+        finally:
+            self.sessions.put(session)
+
+    def map(self, ims, init_masks, method, **params):
+        """Segments the images (e.g. slices of a volume) in parallel, one job per session at a time."""
+        workers = mppool.ThreadPool(self.n_sessions)
+        segs = workers.map(lambda job: self.run(job[0], job[1], method, **params), zip(ims, init_masks))
+        workers.close()
+        workers.join()
+        return segs
+
+    def close(self):
+        for i in range(self.n_sessions):
+            session = self.sessions.get()
+            if session is not None:
+                session.close()
+
+
+def run(im, init_mask, method, slice=0, max_iter=1000, rad=20, alpha=0.1, energy_type=2, display=False, pool=None,
+        show=False, show_now=True):
+    """pool ... SessionPool to use, if None a matlab session is started for this call only"""
+    params = {'max_iter': max_iter, 'rad': rad, 'alpha': alpha, 'energy_type': energy_type, 'display': display}
+    if pool is not None:
+        seg = pool.run(im, init_mask, method, **params)
     else:
-        seg = init_mask.copy()
-    seg = np.array(seg._data).reshape(seg._size[::-1]).T
-    eng.quit()
+        session = MatlabBackend()
+        seg = session.segment(im, init_mask, method, **params)
+        session.close()
 
     if show:
         im_vis = im if im.ndim ==2 else im[slice,...]
@@ -2,6 +2,8 @@ from __future__ import division
 
 import os
 import sys
+import heapq
+import multiprocessing as mp
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -9,6 +11,8 @@ import cv2
 import skimage.morphology as skimor
 import skimage.color as skicol
 import scipy.ndimage.morphology as scindimor
+import scipy.ndimage.filters as scindifil
+import scipy.ndimage.measurements as scindimea
 
 if os.path.exists('/home/tomas/projects/imtools/'):
     sys.path.insert(0, '/home/tomas/projects/imtools/')
@@ -18,9 +22,63 @@ else:
     sys.exit(0)
 
 
+def create_ball(ball_r, ndim=3):
+    """Creates a binary ball (cross-shaped structuring element dilated ball_r - 1 times) of size 2 * ball_r + 1."""
+    strel = scindimor.generate_binary_structure(ndim, 1)
+    tmp = np.zeros((2 * ball_r + 1,) * ndim)
+    tmp[(ball_r,) * ndim] = 1
+    ball = scindimor.binary_dilation(tmp, strel, ball_r - 1)
+    return ball
+
+
+class BallNeighborhood:
+    """Implicit ball neighborhood of voxels in a volume of given shape.
+    Instead of storing the neighbors of every voxel, only the flat offsets of the ball points and a padded volume
+    of linear indices are kept (-1 in the padding). Neighbors of any batch of voxels are then obtained by adding
+    the offsets to the voxels' positions in the padded volume.
+    inputs:
+        shape ... shape of the volume
+        ball_r ... radius of the ball
+        ball ... binary ball mask of size 2 * ball_r + 1, if None it is created by create_ball()
+    """
+    def __init__(self, shape, ball_r, ball=None):
+        self.shape = tuple(shape)
+        self.ball_r = ball_r
+        if ball is None:
+            ball = create_ball(ball_r, len(self.shape))
+        self.ball = ball
+        self.pad_shape = tuple(s + 2 * ball_r for s in self.shape)
+
+        # flat offsets of the ball points in the padded volume
+        coords = np.array(np.nonzero(ball)).T - ball_r
+        strides = np.cumprod((1,) + self.pad_shape[:0:-1])[::-1]
+        self.offsets = np.dot(coords, strides)
+        self.n_ball_pts = len(self.offsets)
+
+        n_pts = np.prod(self.shape)
+        dtype = np.int32 if n_pts < np.iinfo(np.int32).max else np.int64
+        idxs = np.arange(n_pts, dtype=dtype).reshape(self.shape)
+        self.padded = np.pad(idxs, ball_r, mode='constant', constant_values=-1).ravel()
+
+    def to_padded(self, idxs):
+        """Converts linear indices of voxels in the volume to linear indices in the padded volume."""
+        coords = np.unravel_index(idxs, self.shape)
+        return np.ravel_multi_index(tuple(c + self.ball_r for c in coords), self.pad_shape)
+
+    def get_neighbors(self, idxs):
+        """Returns linear indices of the ball points of given voxels.
+        inputs:
+            idxs ... linear indices of voxels, int or ndarray [n]
+        outputs:
+            nghbs ... linear indices of ball points, ndarray [n, n_ball_pts], -1 for points outside the volume
+        """
+        pidxs = self.to_padded(np.atleast_1d(idxs))
+        return self.padded[pidxs[:, np.newaxis] + self.offsets]
+
+
 class LoReGro:
     def __init__(self, im, seeds, im_path=None, energy=None, ball_r_out=1, ball_r=3, min_diff=0.1, alpha=1.,
-                 scale=0.5, max_iters=1000, smoothing=True, show=False, show_now=True):
+                 scale=0.5, max_iters=1000, smoothing=True, engine='loop', show=False, show_now=True):
         if isinstance(im, str):
             self.im_path = im
             self.im = cv2.imread(self.im_path, 0)
@@ -55,6 +113,10 @@ class LoReGro:
         self.alpha = alpha
         self.max_iters = max_iters
         self.smoothing = smoothing
+        # 'loop' ... newbies evaluated one by one, 'boxsum' ... batched evaluation,
+        # 'incremental' ... only newbies around newly accepted voxels are evaluated,
+        # 'srg' ... seeded region growing driven by a priority queue, see grow_srg()
+        self.engine = engine
         self.show = show
         self.show_now = show_now
 
@@ -79,25 +141,38 @@ class LoReGro:
         if self.smoothing:
             self.im = tools.smoothing(self.im, sigmaSpace=5, sigmaColor=5, sliceId=0)
 
-        if scale != 1:
+        if self.scale != 1:
             self.im = tools.resize3D(self.im, self.scale, sliceId=0)
             self.seeds = tools.resize3D(self.seeds, self.scale, sliceId=0)
             self.segmentation = tools.resize3D(self.segmentation, self.scale, sliceId=0)
 
         self.shape = self.im.shape
 
-        print 'Creating nghb matrix ...',
-        self.nghbm = self.create_balls_nghbm()
+        if self.engine == 'boxsum':
+            print 'Calculating ball sums ...',
+            self.init_ball_sums()
+        else:
+            print 'Creating nghb matrix ...',
+            self.nghbm = self.create_balls_nghbm()
         print 'done.'
 
         newbies = self.seeds.copy()
+        if self.engine == 'incremental':
+            self.init_incremental(newbies)
+        elif self.engine == 'srg':
+            self.segmentation = self.grow_srg(newbies)
         curr_it = 0
-        changed = True
+        changed = self.engine != 'srg'  # seeded region growing is not done in sweeps
         while changed and curr_it < self.max_iters:
             curr_it += 1
             print 'iteration #%i/%i' % (curr_it, self.max_iters)
             #            mask, accepted, refused = self.iterationIB( im, mask, ballM, strel, minDiff, alpha )
-            mask_new, accepted, refused = self.iteration_IB(newbies)
+            if self.engine == 'boxsum':
+                mask_new, accepted, refused = self.iteration_IB_boxsum(newbies)
+            elif self.engine == 'incremental':
+                mask_new, accepted, refused = self.iteration_IB_incremental(newbies)
+            else:
+                mask_new, accepted, refused = self.iteration_IB(newbies)
             # plt.figure()
             # plt.subplot(121), plt.imshow(self.segmentation[0,...].copy(), 'gray')
             # plt.subplot(122), plt.imshow(mask_new[0,...].copy(), 'gray')
@@ -109,7 +184,7 @@ class LoReGro:
             #            self.newbies = np.zeros( self.newbies.shape, dtype=np.bool )
             #            self.newbies[accepted[0],accepted[1]] = True
 
-            if not accepted.any():
+            if len(accepted) == 0:
                 changed = False
 
         for i, im in enumerate(self.segmentation):
@@ -117,51 +192,14 @@ class LoReGro:
             # self.segmentation[i,...] = scindimor.binary_closing(self.segmentation, np.ones((3, 3, 3)))
 
         # rescale the segmentation to original shape
-        if scale != 1:
+        if self.scale != 1:
             tmp = np.zeros(self.orig_shape)
             for i, im in enumerate(self.segmentation):
                 tmp[i,...] = cv2.resize(im.astype(np.uint8), (self.orig_shape[2], self.orig_shape[1]))
             self.segmentation = tmp
 
     def create_balls_nghbm(self):
-
-        # creating ball mask
-        strel = np.array([[[0, 0, 0], [0, 1, 0], [0, 0, 0]],
-                          [[0, 1, 0], [1, 1, 1], [0, 1, 0]],
-                          [[0, 0, 0], [0, 1, 0], [0, 0, 0]]])
-
-        tmp = np.zeros((2 * self.ball_r + 1,) * self.ndim)
-        tmp[(self.ball_r,) * self.ndim] = 1
-        ball_im = scindimor.binary_dilation(tmp, strel, self.ball_r - 1)
-        n_ball_pts = ball_im.sum()
-
-        coords = np.nonzero(ball_im)
-        center = (self.ball_r,) * self.ndim
-        # move the coords so that the center lies in 0
-        coords = tuple(coords[i] - center[i] for i in range(self.ndim))
-        coords = np.array(coords).T  # coords in array [npts, dim]
-
-        # creating nghb matrix [n_pts, n_nghbs = # of points in the ball]
-        n_pts = np.prod(self.shape)
-        neighbors_m = np.zeros((n_pts, n_ball_pts))
-        for i in range(n_pts):
-            s, r, c = np.unravel_index(i, self.shape)
-            for j in range(n_ball_pts):
-                s_ball, r_ball, c_ball = coords[j,:]
-                sn = s + s_ball
-                rn = r + r_ball
-                cn = c + c_ball
-
-                slice_ko = sn < 0 or sn > (self.shape[0] - 1)
-                row_ko = rn < 0 or rn > (self.shape[1] - 1)
-                col_ko = cn < 0 or cn > (self.shape[2] - 1)
-                if row_ko or col_ko or slice_ko:
-                    neighbors_m[i, j] = np.NaN
-                else:
-                    index = np.ravel_multi_index((sn, rn, cn), self.shape)
-                    neighbors_m[i, j] = index
-
-        return neighbors_m
+        return BallNeighborhood(self.shape, self.ball_r)
 
     def iteration_IB(self, mask):
         dilm = np.zeros_like(mask)
@@ -213,19 +251,196 @@ class LoReGro:
 
         return mask, accepted, refused
 
+    def init_ball_sums(self):
+        # the number of ball points inside the volume and the sum of their intensities do not change during
+        # the growing, therefore they are calculated only once; outer sums are derived from them
+        self.ball = create_ball(self.ball_r, self.ndim).astype(np.float)
+        self.im_f = self.im.astype(np.float)
+        self.ball_count = scindifil.convolve(np.ones(self.shape), self.ball, mode='constant')
+        self.ball_sum = scindifil.convolve(self.im_f, self.ball, mode='constant')
+
+    def iteration_IB_boxsum(self, mask):
+        """Evaluates all newbies at once. Inner and outer ball means are read from the mask and mask * im
+        convolved with the ball kernel, which is done only in the bounding box of the newbies.
+        Unlike iteration_IB, newbies accepted in this iteration do not affect the others.
+        """
+        dilm = scindimor.binary_dilation(mask, np.ones((1, 3, 3)))
+        newbies = dilm * np.logical_not(mask)
+        newbies_c = np.nonzero(newbies)
+        if len(newbies_c[0]) == 0:
+            return mask, np.zeros((0, self.ndim), dtype=np.int), np.zeros((0, self.ndim), dtype=np.int)
+
+        # bounding box of newbies enlarged by the ball radius
+        bbox = tuple(slice(max(c.min() - self.ball_r, 0), c.max() + self.ball_r + 1) for c in newbies_c)
+        newbies_cr = tuple(c - b.start for c, b in zip(newbies_c, bbox))
+        mask_f = (mask[bbox] > 0).astype(np.float)
+        count_in = scindifil.convolve(mask_f, self.ball, mode='constant')[newbies_cr]
+        sum_in = scindifil.convolve(mask_f * self.im_f[bbox], self.ball, mode='constant')[newbies_cr]
+        count_out = self.ball_count[newbies_c] - count_in
+        sum_out = self.ball_sum[newbies_c] - sum_in
+
+        mean_mask = self.im_f[np.nonzero(mask)].mean()
+        acc = self.accept_newbies(self.im_f[newbies_c], count_in, sum_in, count_out, sum_out, mean_mask)
+
+        newbies_c = np.array(newbies_c).T
+        accepted = newbies_c[acc]
+        refused = newbies_c[np.logical_not(acc)]
+        mask[tuple(accepted.T)] = True
+
+        return mask, accepted, refused
+
+    def accept_newbies(self, ints, count_in, sum_in, count_out, sum_out, mean_mask):
+        """Decides which newbies are accepted given the counts and intensity sums of ball points inside and outside
+        the mask. The same criterion as in iteration_IB, applied to arrays.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist_in = np.absolute(sum_in / count_in - ints)
+            dist_out = np.absolute(sum_out / count_out - ints)
+        dist_mask = np.absolute(mean_mask - ints)
+
+        weight_dist_in = self.alpha * dist_in + (1 - self.alpha) * dist_mask
+        return (weight_dist_in < dist_out) | (np.absolute(dist_in - dist_out) < self.min_diff)
+
+    def get_ball_stats(self, idxs, mask_flat):
+        """Returns counts and intensity sums of ball points inside and outside the mask for voxels given
+        by linear indices.
+        """
+        nghbs = self.nghbm.get_neighbors(idxs)
+        valid = nghbs >= 0
+        nghbs = np.where(valid, nghbs, 0)
+        inside = valid * (mask_flat[nghbs] > 0)
+        ints_ball = self.im_flat[nghbs]
+        count_in = inside.sum(1)
+        sum_in = (ints_ball * inside).sum(1)
+        count_out = valid.sum(1) - count_in
+        sum_out = (ints_ball * valid).sum(1) - sum_in
+        return count_in, sum_in, count_out, sum_out
+
+    def create_front_nghbm(self):
+        # in-plane 8-neighborhood, the same as the dilation used for finding newbies in iteration_IB
+        front_ball = np.zeros((3, 3, 3), dtype=np.bool)
+        front_ball[1, ...] = True
+        front_ball[1, 1, 1] = False
+        return BallNeighborhood(self.shape, 1, ball=front_ball)
+
+    def init_incremental(self, mask):
+        self.front_nghbm = self.create_front_nghbm()
+
+        self.im_flat = self.im.astype(np.float).ravel()
+        mask_flat = mask.ravel() > 0
+        self.region_sum = self.im_flat[mask_flat].sum()
+        self.region_count = mask_flat.sum()
+
+        dilm = scindimor.binary_dilation(mask, np.ones((1, 3, 3)))
+        self.frontier = np.flatnonzero(dilm * np.logical_not(mask))
+        self.dirty = self.frontier.copy()  # newbies that have to be (re)evaluated
+
+    def iteration_IB_incremental(self, mask):
+        """Evaluates only the dirty newbies, i.e. the new ones and those whose ball contains a voxel accepted
+        in the previous iteration. The frontier and the region statistics are updated only around the accepted
+        voxels. Refused newbies with unchanged ball are skipped only if alpha == 1, otherwise the criterion depends
+        also on the mean of the region and the whole frontier is reevaluated whenever the region grows.
+        """
+        mask_flat = mask.ravel()
+        cands = self.dirty
+        if len(cands) == 0:
+            return mask, np.zeros((0, self.ndim), dtype=np.int), np.zeros((0, self.ndim), dtype=np.int)
+
+        mean_mask = self.region_sum / self.region_count
+        stats = self.get_ball_stats(cands, mask_flat)
+        acc = self.accept_newbies(self.im_flat[cands], *stats, mean_mask=mean_mask)
+        accepted = cands[acc]
+        refused = cands[np.logical_not(acc)]
+
+        # updating the region and its statistics
+        mask_flat[accepted] = True
+        self.region_sum += self.im_flat[accepted].sum()
+        self.region_count += len(accepted)
+
+        # updating the frontier around accepted voxels
+        new_front = self.front_nghbm.get_neighbors(accepted).ravel()
+        new_front = np.unique(new_front[new_front >= 0])
+        new_front = new_front[np.logical_not(mask_flat[new_front])]
+        self.frontier = np.union1d(np.setdiff1d(self.frontier, accepted, assume_unique=True), new_front)
+
+        if self.alpha != 1 and len(accepted) > 0:
+            # the mean of the region changed, all newbies have to be reevaluated
+            self.dirty = self.frontier
+        else:
+            # newbies whose ball contains an accepted voxel have to be reevaluated
+            touched = self.nghbm.get_neighbors(accepted).ravel()
+            touched = np.unique(touched[touched >= 0])
+            touched = self.frontier[np.in1d(self.frontier, touched, assume_unique=True)]
+            self.dirty = np.union1d(new_front, touched)
+
+        accepted = np.array(np.unravel_index(accepted, self.shape)).T
+        refused = np.array(np.unravel_index(refused, self.shape)).T
+
+        return mask, accepted, refused
+
+    def grow_srg(self, mask, max_visits=None):
+        """Seeded region growing in the style of Adams and Bischof. Newbies are kept in a heap keyed by the distance
+        of their intensity to the region mean (ties broken by linear index, so the result is deterministic).
+        The closest newbie is popped, tested with the same local criterion as in iteration_IB and if accepted,
+        the region statistics are updated and its neighbors are pushed. A refused newbie is pushed again when
+        another of its neighbors is accepted, but each voxel is visited at most max_visits times.
+        inputs:
+            mask ... initial region (seeds), modified in place
+            max_visits ... maximal number of visits of a voxel, defaults to the number of its neighbors
+        outputs:
+            mask ... the grown region
+        """
+        front_nghbm = self.create_front_nghbm()
+        if max_visits is None:
+            max_visits = front_nghbm.n_ball_pts
+
+        self.im_flat = self.im.astype(np.float).ravel()
+        mask_flat = mask.ravel()
+        region_sum = self.im_flat[mask_flat > 0].sum()
+        region_count = (mask_flat > 0).sum()
+
+        visits = np.zeros(len(mask_flat), dtype=np.uint8)
+        queued = np.zeros(len(mask_flat), dtype=np.bool)
+        dilm = scindimor.binary_dilation(mask, np.ones((1, 3, 3)))
+        newbies = np.flatnonzero(dilm * np.logical_not(mask))
+        mean_mask = region_sum / region_count
+        heap = zip(np.absolute(self.im_flat[newbies] - mean_mask).tolist(), newbies.tolist())
+        heapq.heapify(heap)
+        queued[newbies] = True
+
+        while heap:
+            _, idx = heapq.heappop(heap)
+            queued[idx] = False
+            if mask_flat[idx] or visits[idx] >= max_visits:
+                continue
+            visits[idx] += 1
+
+            mean_mask = region_sum / region_count
+            stats = self.get_ball_stats(idx, mask_flat)
+            if not self.accept_newbies(self.im_flat[idx], *stats, mean_mask=mean_mask)[0]:
+                continue
+
+            mask_flat[idx] = True
+            region_sum += self.im_flat[idx]
+            region_count += 1
+
+            nghbs = front_nghbm.get_neighbors(idx)[0]
+            nghbs = nghbs[nghbs >= 0]
+            nghbs = nghbs[np.logical_not(mask_flat[nghbs] | queued[nghbs]) & (visits[nghbs] < max_visits)]
+            mean_mask = region_sum / region_count
+            for dist, nghb in zip(np.absolute(self.im_flat[nghbs] - mean_mask).tolist(), nghbs.tolist()):
+                heapq.heappush(heap, (dist, nghb))
+            queued[nghbs] = True
+
+        return mask
+
     def mask_newbie(self, newbie, mask):
-        ball_pts = [int(x) for x in self.nghbm[np.ravel_multi_index(newbie, self.shape), :] if not np.isnan(x)]
-        # inners_ind = [x for x in ball_pts if mask[np.unravel_index(x, self.shape)]]
-        inners_ind = []
-        outers_ind = []
-        for i in ball_pts:
-            if mask[np.unravel_index(i, self.shape)]:
-                inners_ind.append(i)
-            else:
-                outers_ind.append(i)
+        ball_pts = self.nghbm.get_neighbors(np.ravel_multi_index(newbie, self.shape))[0]
+        ball_pts = ball_pts[ball_pts >= 0]
+        in_mask = mask.ravel()[ball_pts].astype(np.bool)
 
-        inners = np.unravel_index(inners_ind, self.shape)
-        outers = np.unravel_index(outers_ind, self.shape)
+        inners = np.unravel_index(ball_pts[in_mask], self.shape)
+        outers = np.unravel_index(ball_pts[np.logical_not(in_mask)], self.shape)
 
         # tmp = np.zeros_like(mask)
         # tmp[newbie] = 1
@@ -257,6 +472,103 @@ class LoReGro:
         return dist_in, dist_out
 
 
+_components_data = None
+
+
+def _init_components(im, seeds_lbls, params, margin, max_grows):
+    global _components_data
+    _components_data = (im, seeds_lbls, params, margin, max_grows)
+
+
+def _pad_bbox(bbox, margin, shape):
+    return tuple(slice(max(b.start - margin, 0), min(b.stop + margin, s)) for b, s in zip(bbox, shape))
+
+
+def _touches_bbox(seg, bbox, shape, width=1):
+    # whether the segmentation lies closer than width to a side of the bbox that isn't on the volume border
+    for axis, (b, s) in enumerate(zip(bbox, shape)):
+        n = min(width, seg.shape[axis])
+        if b.start > 0 and seg.take(range(n), axis).any():
+            return True
+        if b.stop < s and seg.take(range(-n, 0), axis).any():
+            return True
+    return False
+
+
+def _grow_component(args):
+    lbl, bbox = args
+    im, seeds_lbls, params, margin, max_grows = _components_data
+    for i in range(max_grows + 1):
+        crop = _pad_bbox(bbox, margin, im.shape)
+        seeds_cr = (seeds_lbls[crop] == lbl).astype(np.uint8)
+        lrg = LoReGro(im[crop], seeds_cr, **params)
+        lrg.run_segmentation()
+        seg = lrg.segmentation > 0
+        # balls of the newbies must fit into the crop
+        if not _touches_bbox(seg, crop, im.shape, width=lrg.ball_r + 1):
+            break
+        # the region reached the side of the crop -> enlarge the crop around the region and grow again
+        bbox = tuple(slice(c.start + b.start, c.start + b.stop) for c, b in zip(crop, scindimea.find_objects(seg)[0]))
+        margin *= 2
+    mean = im[crop][seg].mean() if seg.any() else np.nan
+    return lbl, crop, seg, mean
+
+
+def run_components(im, seeds, n_jobs=None, margin=10, max_grows=3, **params):
+    """Runs LoReGro separately on each connected component of the seeds. Each component is grown in its own
+    bounding box enlarged by margin; if the region gets closer than ball_r + 1 to a side of the box, the box is
+    reset to the bounding box of the region, the margin is doubled and the component is grown again (at most
+    max_grows times). Components are processed in a pool of n_jobs processes.
+    Voxels claimed by more than one component are assigned to the component with the region mean closest to
+    the voxel's intensity, ties are resolved in favor of the lower label.
+    inputs:
+        im ... input image or volume
+        seeds ... seeds mask of the same shape as im
+        n_jobs ... number of processes, defaults to the number of cpus, 1 means no pool
+        margin ... initial margin of the bounding boxes
+        max_grows ... maximal number of enlargements of a bounding box
+        params ... parameters passed to LoReGro
+    outputs:
+        lbls ... label volume, lbls == i + 1 is the region grown from the i-th seeds component
+        seg ... segmentation, union of all regions
+    """
+    if im.ndim == 2:
+        im = np.expand_dims(im, 0)
+    if seeds.ndim == 2:
+        seeds = np.expand_dims(seeds, 0)
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+
+    seeds_lbls, n_comps = scindimea.label(seeds > 0, structure=np.ones((3, 3, 3)))
+    bboxes = scindimea.find_objects(seeds_lbls)
+    jobs = [(i + 1, bbox) for i, bbox in enumerate(bboxes)]
+
+    initargs = (im, seeds_lbls, params, margin, max_grows)
+    if n_jobs == 1:
+        _init_components(*initargs)
+        results = map(_grow_component, jobs)
+    else:
+        pool = mp.Pool(n_jobs, initializer=_init_components, initargs=initargs)
+        results = pool.imap_unordered(_grow_component, jobs)
+
+    # merging the regions
+    lbls = np.zeros(im.shape, dtype=np.int32)
+    dists = np.inf * np.ones(im.shape, dtype=np.float32)
+    for lbl, crop, seg, mean in results:
+        lbls_cr = lbls[crop]
+        dists_cr = dists[crop]
+        dist = np.absolute(im[crop].astype(np.float32) - mean)
+        win = seg & ((dist < dists_cr) | ((dist == dists_cr) & ((lbls_cr == 0) | (lbl < lbls_cr))))
+        lbls_cr[win] = lbl
+        dists_cr[win] = dist[win]
+
+    if n_jobs != 1:
+        pool.close()
+        pool.join()
+
+    return lbls, lbls > 0
+
+
 #---------------------------------------------------------------------------------------------
 #---------------------------------------------------------------------------------------------
 if __name__ == '__main__':
@@ -176,7 +176,8 @@ def comparing(data, methods, params, mask=None, slice_idx=None):
     """
 
     if 'fm' in methods:
-        fm_hypo_init, fm_hyper_init, fm_speed_hypo, fm_speed_hyper = fm.run(data, params, mask)
+        fm_hypo_init, fm_hyper_init, fm_speed_hypo, fm_speed_hyper, fm_hypo_times, fm_hyper_times = \
+            fm.run(data, params, mask=mask)
 
     if 'snakes' in methods:
         snakes.run(data, params, mask=mask)
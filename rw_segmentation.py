@@ -1,5 +1,8 @@
 from __future__ import division
 
+import multiprocessing as mp
+import multiprocessing.sharedctypes as mpsct
+
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -7,30 +10,188 @@ import skimage.segmentation as skiseg
 import skimage.measure as skimea
 
 import scipy.ndimage.measurements as scindimea
+import scipy.ndimage.morphology as scindimor
 
-# import tools
-import os
-import sys
-if os.path.exists('../imtools/'):
-    sys.path.append('../imtools/')
-    from imtools import tools
-else:
-    print 'You need to import package imtools: https://github.com/mjirik/imtools'
-    sys.exit(0)
-
-import sys
-
-def rw_segmentation(im, seeds, slicewise):
+def rw_segmentation(im, seeds, slicewise, mode='bf', multires=False):
     if slicewise:
         seg = np.zeros_like(seeds)
         for i, (im_s, seeds_s) in enumerate(zip(im, seeds)):
-            seg[i, :, :] = skiseg.random_walker(im_s, seeds_s)
+            seg[i, :, :] = skiseg.random_walker(im_s, seeds_s, mode=mode)
+    elif multires:
+        seg = rw_multires(im, seeds, mode=mode)
     else:
-        seg = skiseg.random_walker(im, seeds)
+        seg = skiseg.random_walker(im, seeds, mode=mode)
+
+    return seg
+
+
+def rw_multires(im, seeds, factor=2, band=2, beta=130, mode='bf'):
+    """Coarse-to-fine random walker. The problem is solved on data downsampled by factor first, the probabilities
+    are upsampled and the labels are fixed as seeds everywhere except in a band of width band around the label
+    boundaries. Then only the band is solved at full resolution (cropped to its bounding box).
+    As random_walker normalizes beta by the std of its input, beta is rescaled for the downsampled and cropped data
+    to get the same edge weights as for the whole input.
+    """
+    shape = np.array(im.shape)
+    coarse_shape = np.maximum(shape // factor, 1)
+    if factor <= 1 or (coarse_shape < 2).any():
+        return skiseg.random_walker(im, seeds, beta=beta, mode=mode)
+    im = im.astype(np.float)
+    im_std = im.std()
+
+    # downsampling - block means of the data, seeds of a coarse voxel are kept only if they agree
+    coarse_idxs = [np.minimum(np.arange(s) * c // s, c - 1) for s, c in zip(shape, coarse_shape)]
+    coarse_lin = np.ravel_multi_index(np.ix_(*coarse_idxs), coarse_shape).ravel()
+    n_coarse = np.prod(coarse_shape)
+    im_c = np.bincount(coarse_lin, weights=im.ravel(), minlength=n_coarse) / np.bincount(coarse_lin, minlength=n_coarse)
+    im_c = im_c.reshape(coarse_shape)
+    labeled = seeds.ravel() != 0
+    lbls_max = -np.inf * np.ones(n_coarse)
+    lbls_min = np.inf * np.ones(n_coarse)
+    np.maximum.at(lbls_max, coarse_lin[labeled], seeds.ravel()[labeled])
+    np.minimum.at(lbls_min, coarse_lin[labeled], seeds.ravel()[labeled])
+    seeds_c = np.where(lbls_max == lbls_min, lbls_max, 0).astype(seeds.dtype).reshape(coarse_shape)
+
+    lbls = np.unique(seeds_c[seeds_c > 0])
+    if len(lbls) < 2:
+        return skiseg.random_walker(im, seeds, beta=beta, mode=mode)
+    probs_c = skiseg.random_walker(im_c, seeds_c, beta=beta * im_c.std() / im_std, mode=mode, return_full_prob=True)
+
+    # upsampling the probabilities (nearest neighbor) and labeling
+    seg = lbls[np.argmax(probs_c, axis=0)][np.ix_(*coarse_idxs)].astype(seeds.dtype)
+
+    # uncertain band around the boundaries of labels
+    strel = np.ones((3,) * im.ndim)
+    boundary = scindimor.grey_dilation(seg, footprint=strel) != scindimor.grey_erosion(seg, footprint=strel)
+    uncertain = scindimor.binary_dilation(boundary, strel, iterations=band)
+    if not uncertain.any():
+        return seg
+
+    # refinement - everything outside the band is fixed as seeds
+    seeds_f = np.where(uncertain, 0, seg)
+    seeds_f[seeds != 0] = seeds[seeds != 0]
+    coords = np.nonzero(uncertain)
+    crop = tuple(slice(max(c.min() - 1, 0), c.max() + 2) for c in coords)
+    im_cr = im[crop]
+    seeds_cr = seeds_f[crop]
+    if (seeds_cr == 0).any() and len(np.unique(seeds_cr[seeds_cr > 0])) > 1:
+        seg[crop] = skiseg.random_walker(im_cr, seeds_cr, beta=beta * im_cr.std() / im_std, mode=mode)
 
     return seg
 
 
+def get_component_bboxes(lbls, pad=0, merge_dist=0):
+    """Returns bounding boxes of labeled components found in a single pass by scipy.ndimage.find_objects.
+    The boxes are padded and boxes that overlap or are closer than merge_dist are merged into one box, so that
+    the resulting boxes are disjoint.
+    inputs:
+        lbls ... label volume
+        pad ... padding of the boxes
+        merge_dist ... boxes closer than this are merged, 0 means only overlapping boxes are merged
+    outputs:
+        bboxes ... list of bounding boxes, tuples of slices
+    """
+    shape = np.array(lbls.shape)
+    boxes = [(np.array([s.start for s in b]), np.array([s.stop for s in b]))
+             for b in scindimea.find_objects(lbls) if b is not None]
+    boxes = [(np.maximum(start - pad, 0), np.minimum(stop + pad, shape)) for start, stop in boxes]
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                (start1, stop1), (start2, stop2) = boxes[i], boxes[j]
+                if ((start1 < stop2 + merge_dist) & (start2 < stop1 + merge_dist)).all():
+                    boxes[i] = (np.minimum(start1, start2), np.maximum(stop1, stop2))
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return [tuple(slice(a, b) for a, b in zip(start, stop)) for start, stop in boxes]
+
+
+def to_shared(arr):
+    """Copies an array to shared memory, returns the buffer and the array viewing it."""
+    buf = mpsct.RawArray('b', arr.nbytes)
+    shared = np.frombuffer(buf, dtype=arr.dtype).reshape(arr.shape)
+    shared[...] = arr
+    return buf, shared
+
+
+_rw_shared = None
+
+
+def _init_rw_worker(data_buf, data_dtype, seeds_buf, seeds_dtype, shape, mode, multires):
+    global _rw_shared
+    data = np.frombuffer(data_buf, dtype=data_dtype).reshape(shape)
+    seeds = np.frombuffer(seeds_buf, dtype=seeds_dtype).reshape(shape)
+    _rw_shared = (data, seeds, mode, multires)
+
+
+def _rw_job(job):
+    job_id, bbox, slice_idx = job
+    data, seeds, mode, multires = _rw_shared
+    im_cr = data[bbox]
+    seeds_cr = seeds[bbox]
+    if slice_idx is not None:
+        return job_id, skiseg.random_walker(im_cr[slice_idx], seeds_cr[slice_idx], mode=mode)
+    return job_id, rw_segmentation(im_cr, seeds_cr, slicewise=False, mode=mode, multires=multires)
+
+
+def rw_scheduler(data, seeds, bboxes, slicewise=True, mode='bf', multires=False, n_jobs=None):
+    """Runs random walker on the given bounding boxes in a pool of processes. A job is one bounding box or,
+    if slicewise, one slice of a bounding box. Data and seeds are passed to the workers through shared memory,
+    the results are written into a preallocated output as they come.
+    inputs:
+        data ... input volume
+        seeds ... seeds of the same shape as data
+        bboxes ... bounding boxes, tuples of slices
+        slicewise ... whether to segment bounding boxes slice by slice
+        mode ... solver of skimage.segmentation.random_walker - 'bf', 'cg' or 'cg_mg'
+        multires ... whether to use coarse-to-fine random walker (only if not slicewise), see rw_multires()
+        n_jobs ... number of processes, defaults to the number of cpus, 1 means no pool
+    outputs:
+        segs ... sum of segmentations (labels - 1) of all bounding boxes
+    """
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+
+    jobs = []
+    for bbox in bboxes:
+        if slicewise:
+            n_slices = bbox[0].stop - bbox[0].start
+            jobs.extend([(len(jobs) + i, bbox, i) for i in range(n_slices)])
+        else:
+            jobs.append((len(jobs), bbox, None))
+
+    data_buf, _ = to_shared(data)
+    seeds_buf, _ = to_shared(seeds)
+    initargs = (data_buf, data.dtype, seeds_buf, seeds.dtype, data.shape, mode, multires)
+    if n_jobs == 1:
+        _init_rw_worker(*initargs)
+        results = (_rw_job(job) for job in jobs)
+    else:
+        pool = mp.Pool(n_jobs, initializer=_init_rw_worker, initargs=initargs)
+        results = pool.imap_unordered(_rw_job, jobs)
+
+    segs = np.zeros_like(data)
+    for job_id, seg in results:
+        _, bbox, slice_idx = jobs[job_id]
+        segs_cr = segs[bbox]
+        if slice_idx is not None:
+            segs_cr = segs_cr[slice_idx]
+        segs_cr += seg - 1
+
+    if n_jobs != 1:
+        pool.close()
+        pool.join()
+
+    return segs
+
+
 # def run_slicewise(data, seeds, mask=None, separe=False, bg_lbl=1):
 #     if separe:
 #         bg = data == bg_lbl
@@ -42,36 +203,23 @@ def rw_segmentation(im, seeds, slicewise):
 #             props = skimea.regionprops(bg)
 
 
-def run(data, seeds, mask=None, separe=True, bg_lbl=1, slicewise=True):
+def run(data, seeds, mask=None, separe=True, bg_lbl=1, slicewise=True, mode='bf', multires=False, n_jobs=None,
+        pad=0, merge_dist=0):
     segs = None
 
     if isinstance(seeds, str):
         seeds = np.load(seeds)
 
     if separe:
-        bg = data == bg_lbl
-
         bg_lbls, n_bgs = scindimea.label(seeds==1, structure=np.ones((3, 3, 3)))
 
-        # deriving bboxes
-        bboxes = []
-        for i in range(n_bgs):
-            bg = bg_lbls == i + 1
-            # s_min, s_max, r_min, r_max, c_min, c_max = tools.get_bbox(bg)
-            bbox = tools.get_bbox(bg)
-            bboxes.append(bbox)
+        # deriving bboxes, overlapping ones are merged so that each voxel is segmented at most once
+        bboxes = get_component_bboxes(bg_lbls, pad=pad, merge_dist=merge_dist)
 
         # segmentation
-        segs = np.zeros_like(data)
-        for bbox in bboxes:
-            im_cr = data[bbox[0]:bbox[1] + 1, bbox[2]:bbox[3] + 1, bbox[4]:bbox[5] + 1]
-            seeds_cr = seeds[bbox[0]:bbox[1] + 1, bbox[2]:bbox[3] + 1, bbox[4]:bbox[5] + 1]
-
-            seg = rw_segmentation(im_cr, seeds_cr, slicewise) - 1
-            segs[bbox[0]:bbox[1] + 1, bbox[2]:bbox[3] + 1, bbox[4]:bbox[5] + 1] += seg
+        segs = rw_scheduler(data, seeds, bboxes, slicewise=slicewise, mode=mode, multires=multires, n_jobs=n_jobs)
 
-            # data visualization
-            # tools.show_3d((im_cr, seg))
-            # tools.show_3d((data, segs))
+        # data visualization
+        # tools.show_3d((data, segs))
 
     return segs
\ No newline at end of file
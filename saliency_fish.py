@@ -581,9 +581,12 @@ def conspicuity_blobs(im, mask, use_sigmoid=False, a=3, morph_proc=True, type='h
     # blob_types = [blobs.BLOB_CV,]
     # blobs_survs = []
     surv_overall = np.zeros_like(im)
+    # scale spaces are computed once and shared by all blob types
+    scale_spaces = blobs.create_scale_spaces(im)
     for blob_type in blob_types:
         blobs_res, survs_res, titles, params = blobs.detect_blobs(im, mask, blob_type, layer_id=0,
-                                                                  show=show, show_now=show_now, verbose=verbose)
+                                                                  show=show, show_now=show_now, verbose=verbose,
+                                                                  scale_spaces=scale_spaces)
         # blobs_survs.append(survs_res[0])
         surv_overall += survs_res[0].astype(surv_overall.dtype)
 
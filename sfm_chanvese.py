@@ -0,0 +1,324 @@
+from __future__ import division
+
+import numpy as np
+import matplotlib.pyplot as plt
+import skimage.io as skiio
+import skimage.transform as skitra
+from skimage import img_as_ubyte
+
+
+def gaussian_ball(rad, ndim=2):
+    """Gaussian of size floor(rad) * 2 + 1 in every dimension with sigma = rad / 2, normalized to sum 1."""
+    irad = int(np.floor(rad))
+    grid = np.mgrid[(slice(-irad, irad + 1),) * ndim]
+    ball = np.exp(-(grid ** 2).sum(0) / (2 * (rad / 2) ** 2))
+    return ball / ball.sum()
+
+
+class SparseFieldChanVese:
+    """Localized Chan-Vese active contour evolved by the sparse field method (Whitaker), a NumPy port of
+    sfm_chanvese_demo/sfm_local_chanvese (lsops3c.cpp, energy3c.cpp).
+    The level set is kept only in five layers (Ln2, Ln1, Lz, Lp1, Lp2) stored as arrays of linear indices into
+    a padded volume; phi is -3 / 3 inside / outside the layers and nan in the padding. Local statistics
+    (gaussian weighted sums and areas inside and outside the contour) are computed for a point the first time
+    it appears on the zero level set and then updated incrementally by the points that cross the interface.
+    The layers are kept in the order of the linked lists of the original, so the result is the same in 2D and 3D
+    (see test_sfm_chanvese.py) as long as no point of the zero level set has an empty local region inside or outside,
+    where the original uses an undefined mean.
+    inputs:
+        im ... grayscale image or volume
+        mask ... initial mask, 1's foreground
+        rad ... radius of the ball used for localization
+        alpha ... weight of the curvature term
+    """
+    def __init__(self, im, mask, rad=10, alpha=0.1):
+        self.shape = im.shape
+        self.rad = rad
+        self.alpha = alpha
+        self.pad = max(int(np.floor(rad)), 1)
+        self.pad_shape = tuple(s + 2 * self.pad for s in self.shape)
+        self.img = np.pad(im.astype(np.float64), self.pad, mode='constant').ravel()
+
+        # neighbors along the axes and ball points as flat offsets in the padded volume
+        strides = np.cumprod((1,) + self.pad_shape[:0:-1])[::-1]
+        self.axis_offsets = strides
+        # the order in which lsops3c.cpp visits the neighbors: +y, -y, +x, -x, +z, -z (y, x, z being the axes 0, 1, 2)
+        self.nghb_offsets = np.vstack((strides, -strides)).T.ravel()
+        ball = gaussian_ball(rad, im.ndim)
+        coords = np.array(np.nonzero(np.ones(ball.shape))).T - int(np.floor(rad))
+        self.ball_offsets = np.dot(coords, strides)
+        self.ball_weights = ball.ravel()
+        self.chunk_size = max(1, 2 ** 20 // len(self.ball_offsets))
+
+        n_pts = self.img.size
+        self.has_stats = np.zeros(n_pts, dtype=np.bool)
+        self.sum_in = np.zeros(n_pts)
+        self.area_in = np.zeros(n_pts)
+        self.sum_out = np.zeros(n_pts)
+        self.area_out = np.zeros(n_pts)
+        self.scale = 0
+
+        with np.errstate(invalid='ignore'):
+            self.init_layers(mask)
+
+    def unpad(self, arr):
+        return arr.reshape(self.pad_shape)[(slice(self.pad, -self.pad),) * len(self.shape)]
+
+    def get_neighbors(self, idxs):
+        """Neighbors along the axes of given points, ndarray [2 * ndim, n]."""
+        return idxs[np.newaxis, :] + self.nghb_offsets[:, np.newaxis]
+
+    def first_reached(self, srcs, cond):
+        """Points satisfying cond that neighbor srcs in the order a sequential scan of srcs reaches them, and for each
+        of them the point of srcs that reaches it first."""
+        nghbs = self.get_neighbors(srcs).T.ravel()
+        owners = np.repeat(srcs, len(self.nghb_offsets))
+        valid = cond[nghbs]
+        nghbs = nghbs[valid]
+        owners = owners[valid]
+        first = np.sort(np.unique(nghbs, return_index=True)[1])
+        return nghbs[first], owners[first]
+
+    def init_layers(self, mask):
+        inside = np.pad(mask > 0, self.pad, mode='constant', constant_values=True).ravel()
+        in_grid = np.pad(np.ones(self.shape, dtype=np.bool), self.pad, mode='constant').ravel()
+        self.phi = np.where(inside, -3., 3.)
+        self.phi[~in_grid] = np.nan
+        self.label = self.phi.copy()
+
+        # interface = inner points with an outer neighbor
+        pts = np.nonzero(inside & in_grid)[0]
+        lz = pts[(~inside[self.get_neighbors(pts)]).any(0)]
+        # the layers are kept in the order of the linked lists of lsops3c.cpp, which pushes points to the head,
+        # ls_mask2phi3c scans the volume along the axis 1, then 0, then 2
+        coords = np.unravel_index(lz, self.pad_shape)
+        self.lz = lz[np.lexsort(coords[2:] + coords[:2])][::-1]
+        self.phi[self.lz] = 0
+        self.label[self.lz] = 0
+
+        nghbs = self.first_reached(self.lz, np.abs(self.label) == 3)[0]
+        self.ln1 = nghbs[self.phi[nghbs] < 0][::-1]
+        self.lp1 = nghbs[self.phi[nghbs] > 0][::-1]
+        self.phi[self.ln1] = self.label[self.ln1] = -1
+        self.phi[self.lp1] = self.label[self.lp1] = 1
+
+        self.ln2 = self.first_reached(self.ln1, self.label == -3)[0][::-1]
+        self.phi[self.ln2] = self.label[self.ln2] = -2
+        self.lp2 = self.first_reached(self.lp1, self.label == 3)[0][::-1]
+        self.phi[self.lp2] = self.label[self.lp2] = 2
+
+    def init_stats(self, idxs):
+        """Computes the local statistics of given points from scratch."""
+        for i in range(0, len(idxs), self.chunk_size):
+            pts = idxs[i:i + self.chunk_size]
+            ball_pts = pts[:, np.newaxis] + self.ball_offsets
+            phi = self.phi[ball_pts]
+            w_in = (phi <= 0) * self.ball_weights
+            w_out = (phi > 0) * self.ball_weights
+            ints = self.img[ball_pts]
+            self.area_in[pts] = w_in.sum(1)
+            self.sum_in[pts] = (w_in * ints).sum(1)
+            self.area_out[pts] = w_out.sum(1)
+            self.sum_out[pts] = (w_out * ints).sum(1)
+        self.has_stats[idxs] = True
+
+    def update_stats(self, in2out, out2in):
+        """Moves given points from the inner to the outer statistics (and vice versa) of all points around."""
+        for idxs, sign in ((in2out, -1), (out2in, 1)):
+            for i in range(0, len(idxs), self.chunk_size):
+                pts = idxs[i:i + self.chunk_size]
+                ball_pts = pts[:, np.newaxis] + self.ball_offsets
+                weights = np.broadcast_to(self.ball_weights, ball_pts.shape)
+                vals = self.img[pts][:, np.newaxis] * weights
+                valid = self.has_stats[ball_pts]
+                ball_pts, weights, vals = ball_pts[valid], weights[valid], vals[valid]
+                np.add.at(self.sum_in, ball_pts, sign * vals)
+                np.add.at(self.area_in, ball_pts, sign * weights)
+                np.add.at(self.sum_out, ball_pts, -sign * vals)
+                np.add.at(self.area_out, ball_pts, -sign * weights)
+
+    def curvature(self, idxs):
+        """Curvature of the level set as in en_kappa_pt (energy3c.cpp). The mixed derivatives with the third axis
+        (dxz, dyz there) are taken with the opposite sign there, which is kept so that 3D results match.
+        """
+        phi = self.phi
+        c = phi[idxs]
+        d = []
+        dd = []
+        for off in self.axis_offsets:
+            d.append(np.nan_to_num((phi[idxs - off] - phi[idxs + off]) / 2))
+            dd.append(np.nan_to_num(phi[idxs - off] - 2 * c + phi[idxs + off]))
+        d2 = [x ** 2 for x in d]
+        d2_sum = sum(d2)
+
+        kappa = sum(dd[i] * (d2_sum - d2[i]) for i in range(len(d)))
+        for i in range(len(d)):
+            for j in range(i + 1, len(d)):
+                oi, oj = self.axis_offsets[i], self.axis_offsets[j]
+                dij = (phi[idxs - oi - oj] + phi[idxs + oi + oj] - phi[idxs - oj + oi] - phi[idxs + oj - oi]) / 4
+                if j == 2:
+                    dij = -dij
+                kappa -= 2 * d[i] * d[j] * np.nan_to_num(dij)
+        return kappa / (d2_sum + 1e-8)
+
+    def compute_force(self):
+        lz = self.lz
+        self.init_stats(lz[~self.has_stats[lz]])
+        ints = self.img[lz]
+        area_in = self.area_in[lz]
+        area_out = self.area_out[lz]
+        # empty local region (up to the rounding of the incremental updates) does not contribute, energy3c.cpp leaves
+        # the mean undefined there (the value of the previous point is used)
+        nonempty_in = area_in > 1e-10
+        nonempty_out = area_out > 1e-10
+        u = np.where(nonempty_in, self.sum_in[lz] / np.where(nonempty_in, area_in, 1), ints)
+        v = np.where(nonempty_out, self.sum_out[lz] / np.where(nonempty_out, area_out, 1), ints)
+        force = (ints - u) ** 2 - (ints - v) ** 2
+        if self.scale == 0:
+            self.scale = max(np.abs(force).max(), 1e-5)
+        return force / self.scale + self.alpha * self.curvature(lz)
+
+    def max_hood(self, idxs, level):
+        nghbs = self.get_neighbors(idxs)
+        return np.where(self.label[nghbs] >= level, self.phi[nghbs], -3).max(0)
+
+    def min_hood(self, idxs, level):
+        nghbs = self.get_neighbors(idxs)
+        return np.where(self.label[nghbs] <= level, self.phi[nghbs], 3).min(0)
+
+    def update_layers(self, force):
+        """Moves the zero level set by force and rebuilds the other layers, see ls_iteration in lsops3c.cpp.
+        outputs:
+            in2out, out2in ... points of the zero level set that crossed the interface
+        """
+        phi = self.phi
+        label = self.label
+
+        # 1) add normalized force to phi(Lz)
+        # the layers are in the order of the linked lists of lsops3c.cpp, points moved to a list are pushed to its head
+        force = force / max(np.abs(force).max(), 0.001) * 0.4
+        phi_old = phi[self.lz]
+        phi_new = phi_old + force
+        phi[self.lz] = phi_new
+        in2out = self.lz[(phi_old <= 0) & (phi_new > 0)][::-1]
+        out2in = self.lz[(phi_old > 0) & (phi_new <= 0)][::-1]
+        p1_z = self.lz[phi_new > 0.5]
+        n1_z = self.lz[phi_new < -0.5]
+        self.lz = self.lz[np.abs(phi_new) <= 0.5]
+
+        # 2) update Ln1, Lp1, Ln2, Lp2
+        p = self.max_hood(self.ln1, 0)
+        found = p >= -0.5
+        phi[self.ln1[found]] = p[found] - 1
+        p = np.where(found, p - 1, -3)
+        z_n1 = self.ln1[p >= -0.5]
+        n2_n1 = self.ln1[p < -1.5]
+        self.ln1 = self.ln1[(p >= -1.5) & (p < -0.5)]
+
+        p = self.min_hood(self.lp1, 0)
+        found = p <= 0.5
+        phi[self.lp1[found]] = p[found] + 1
+        p = np.where(found, p + 1, 3)
+        z_p1 = self.lp1[p <= 0.5]
+        p2_p1 = self.lp1[p > 1.5]
+        self.lp1 = self.lp1[(p <= 1.5) & (p > 0.5)]
+
+        p = self.max_hood(self.ln2, -1)
+        found = p >= -1.5
+        phi[self.ln2[found]] = p[found] - 1
+        p = np.where(found, p - 1, -3)
+        n1_n2 = self.ln2[p >= -1.5]
+        removed = self.ln2[p < -2.5]
+        phi[removed] = label[removed] = -3
+        self.ln2 = self.ln2[(p < -1.5) & (p >= -2.5)]
+
+        p = self.min_hood(self.lp2, 1)
+        found = p <= 1.5
+        phi[self.lp2[found]] = p[found] + 1
+        p = np.where(found, p + 1, 3)
+        p1_p2 = self.lp2[p <= 1.5]
+        removed = self.lp2[p > 2.5]
+        phi[removed] = label[removed] = 3
+        self.lp2 = self.lp2[(p > 1.5) & (p <= 2.5)]
+
+        # 3) move the points from status lists to the layers, add new points to the outer layers
+        self.lz = np.hstack((z_n1, z_p1, self.lz))
+        label[self.lz] = 0
+
+        # the status lists Sn1 and Sp1 are scanned from the head, a new point takes its value from the first point
+        # that reaches it
+        s_n1 = np.hstack((n1_z, n1_n2))[::-1]
+        label[s_n1] = -1
+        new, owners = self.first_reached(s_n1, phi == -3)
+        phi[new] = phi[owners] - 1
+        self.ln1 = np.hstack((s_n1[::-1], self.ln1))
+
+        s_p1 = np.hstack((p1_z, p1_p2))[::-1]
+        label[s_p1] = 1
+        new_p, owners = self.first_reached(s_p1, phi == 3)
+        phi[new_p] = phi[owners] + 1
+        self.lp1 = np.hstack((s_p1[::-1], self.lp1))
+
+        s_n2 = np.hstack((n2_n1, new))
+        self.ln2 = np.hstack((s_n2, self.ln2))
+        label[s_n2] = -2
+        s_p2 = np.hstack((p2_p1, new_p))
+        self.lp2 = np.hstack((s_p2, self.lp2))
+        label[s_p2] = 2
+
+        return in2out, out2in
+
+    def iteration(self):
+        # comparisons with nan in the padding are meant to be False
+        with np.errstate(invalid='ignore'):
+            force = self.compute_force()
+            in2out, out2in = self.update_layers(force)
+            self.update_stats(in2out, out2in)
+
+    def run(self, max_iter=1000):
+        for i in range(max_iter):
+            if len(self.lz) == 0:
+                break
+            self.iteration()
+
+    def get_seg(self):
+        return self.unpad(self.phi) <= 0
+
+    def get_phi(self):
+        return self.unpad(self.phi)
+
+
+def run(im, mask, max_iter=1000, rad=10, alpha=0.1):
+    """Segmentation by localized Chan-Vese energy evolved by the sparse field method.
+    inputs:
+        im ... grayscale image or volume
+        mask ... initial mask, 1's foreground
+        max_iter ... number of iterations
+        rad ... radius of the ball used for localization
+        alpha ... weight of the curvature term (usually in [0, 1])
+    outputs:
+        seg ... binary segmentation
+    """
+    sfm = SparseFieldChanVese(im, mask, rad=rad, alpha=alpha)
+    sfm.run(max_iter)
+    return sfm.get_seg()
+
+
+#---------------------------------------------------------------------------------------------
+#---------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    im = skiio.imread('localized_seg/monkey.png', as_grey=True)
+
+    mask = np.zeros(im.shape[:2], dtype=np.bool)
+    mask[37:213, 89:227] = 1
+
+    im = skitra.rescale(im, scale=0.5)
+    im = img_as_ubyte(im)
+    mask = skitra.rescale(mask, scale=0.5, preserve_range=True).astype(np.bool)
+
+    seg = run(im, mask, max_iter=1000, rad=10, alpha=0.1)
+
+    plt.figure()
+    plt.subplot(121), plt.imshow(im, 'gray'), plt.contour(mask, [0.5], colors='r'), plt.title('init mask')
+    plt.subplot(122), plt.imshow(im, 'gray'), plt.contour(seg, [0.5], colors='r'), plt.title('segmentation')
+    plt.show()
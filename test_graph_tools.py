@@ -0,0 +1,38 @@
+import unittest
+
+import numpy as np
+import networkx as nx
+
+import graph_tools as gt
+
+
+def grid_graph(n_rows, n_cols, seed=0):
+    rng = np.random.RandomState(seed)
+    G = nx.convert_node_labels_to_integers(nx.grid_2d_graph(n_rows, n_cols), ordering='sorted')
+    for u, v in G.edges():
+        G[u][v]['weight'] = rng.rand()
+    return G
+
+
+class TestMSTHierarchy(unittest.TestCase):
+    def test_cut_matches_splitMST(self):
+        for seed in range(10):
+            G = grid_graph(5, 5, seed)
+            mst = gt.MSTHierarchy(G)
+            T = nx.minimum_spanning_tree(G)
+            for n_segments in range(2, 7):
+                ccs = list(gt.splitMST(T))
+                labels, costs = mst.cut(n_segments)
+                segs = set(frozenset(np.flatnonzero(labels == l)) for l in range(labels.max() + 1))
+                self.assertEqual(segs, set(frozenset(cc.nodes()) for cc in ccs))
+                for cc in ccs:
+                    self.assertAlmostEqual(costs[labels[cc.nodes()[0]]], gt.getGraphCost(cc))
+
+    def test_no_single_node_segments(self):
+        G = grid_graph(4, 6, 3)
+        labels = gt.MSTHierarchy(G).get_labels(4)
+        self.assertTrue((np.bincount(labels) > 1).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import unittest
+
+import numpy as np
+
+import sfm_chanvese
+
+try:
+    import matlab.engine
+    import matlab
+except ImportError:
+    matlab = None
+
+
+def make_volume(shape, seed=0):
+    """Noisy bright ellipsoid on a darker background and a box initialization inside it."""
+    rng = np.random.RandomState(seed)
+    grid = np.mgrid[[slice(0, s) for s in shape]].astype(np.float)
+    center = np.array(shape)[(slice(None),) + (np.newaxis,) * len(shape)] / 2.
+    semi = np.array(shape)[(slice(None),) + (np.newaxis,) * len(shape)] / 3.
+    inside = (((grid - center) / semi) ** 2).sum(0) < 1
+    im = np.clip(np.where(inside, 150, 60) + rng.normal(0, 25, shape), 0, 255).astype(np.uint8)
+    mask = np.zeros(shape, dtype=np.bool)
+    mask[tuple(slice(s // 3, s // 3 + max(s // 3, 1)) for s in shape)] = True
+    return im, mask
+
+
+@unittest.skipIf(matlab is None, 'Matlab engine for python is not installed.')
+class TestAgainstMatlab(unittest.TestCase):
+    """Compares the port with the original mex implementation (sfm_chanvese_demo/sfm_local_chanvese)."""
+    @classmethod
+    def setUpClass(cls):
+        cls.eng = matlab.engine.start_matlab()
+        cls.eng.addpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sfm_chanvese_demo'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.eng.quit()
+
+    def compare(self, im, mask, max_iter, rad, alpha):
+        seg_ml = self.eng.sfm_local_chanvese(matlab.uint8(im.tolist()), matlab.logical(mask.tolist()), max_iter,
+                                             float(alpha), float(rad), False, nargout=1)
+        seg = sfm_chanvese.run(im, mask, max_iter=max_iter, rad=rad, alpha=alpha)
+        np.testing.assert_array_equal(seg, np.array(seg_ml, dtype=np.bool).reshape(im.shape))
+
+    def test_2d(self):
+        im, mask = make_volume((60, 70))
+        self.compare(im, mask, 300, 10, 0.1)
+
+    def test_3d(self):
+        im, mask = make_volume((12, 30, 30))
+        self.compare(im, mask, 300, 3, 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()